@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# needs python 3.9+ for tracemalloc.reset_peak
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from new import MovieRecommendationProgram
+
+
+def generate_ratings(users=1000, movies=500, density=0.02, popularity=1.0, activity=0.5, seed=0):
+    """(user_ids, movie_ids, ratings) of a synthetic ratings stream in random order
+
+    about users * movies * density distinct (user, movie) pairs are drawn, a movie is
+    picked with probability proportional to rank ** -popularity and a user with
+    rank ** -activity, so a few blockbusters and heavy users get most of the ratings.
+    Ratings are 0.5 steps from 0.5 to 5.0 around a per-movie quality and a per-user bias
+    """
+    random = numpy.random.default_rng(seed)
+    count = max(1, int(users * movies * density))
+    movie_weights = numpy.arange(1, movies + 1, dtype=numpy.float64) ** -popularity
+    user_weights = numpy.arange(1, users + 1, dtype=numpy.float64) ** -activity
+    # popular movies and heavy users get random ids, not the smallest ones
+    movie_ids = random.permutation(movies)[random.choice(movies, count, p=movie_weights / movie_weights.sum())] + 1
+    user_ids = random.permutation(users)[random.choice(users, count, p=user_weights / user_weights.sum())] + 1
+    _, first = numpy.unique(user_ids * (movies + 1) + movie_ids, return_index=True)
+    user_ids, movie_ids = user_ids[first], movie_ids[first]
+    order = random.permutation(len(user_ids))
+    user_ids, movie_ids = user_ids[order], movie_ids[order]
+
+    quality = random.normal(3.5, 0.7, movies + 1)
+    bias = random.normal(0.0, 0.5, users + 1)
+    ratings = quality[movie_ids] + bias[user_ids] + random.normal(0.0, 0.8, len(user_ids))
+    ratings = numpy.clip(numpy.round(ratings * 2) / 2, 0.5, 5.0)
+    return user_ids, movie_ids, ratings
+
+
+def write_ratings(stream, user_ids, movie_ids, ratings, chunk_size=100000):
+    """write ratings as the "user_id,movie_id,rating" lines both programs read"""
+    for start in range(0, len(user_ids), chunk_size):
+        part = slice(start, start + chunk_size)
+        stream.write("".join("%d,%d,%.1f\n" % row for row in zip(user_ids[part].tolist(), movie_ids[part].tolist(),
+                                                                      ratings[part].tolist())))
+
+
+class BenchmarkProgram(MovieRecommendationProgram):
+    """MovieRecommendationProgram that leaves running every stage to the benchmark"""
+
+    def run(self):
+        pass
+
+
+class StageTimer(object):
+    """wall time and peak traced memory of named stages"""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = [] # [{'program', 'stage', 'seconds', 'peak_mb'}]
+
+    @contextlib.contextmanager
+    def stage(self, program, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2.0 ** 20 if self.trace_memory else None
+        self.stages.append({"program": program, "stage": name, "seconds": seconds, "peak_mb": peak_mb})
+
+
+def benchmark_new(timer, data, top_n=None, similar_top_k=None, item_based=False, max_items_per_user=None,
+                  max_users_per_movie=None, als=False, workers=(None,), item_top_k=50):
+    """time the stages of new.py on the ratings text data
+
+    the scoring stages run once for every count of worker processes in workers,
+    None scores in this process
+    """
+    program = BenchmarkProgram(top_n=top_n)
+    with timer.stage("new", "ingest"):
+        columns = program.parse_ratings(data.encode(), 1, [])
+    with timer.stage("new", "matrix build"):
+        program.load_ratings(*columns)
+    with timer.stage("new", "cooccurrence matrix"):
+        program.do_cooccurrence_algorithm(top_n=top_n, score_users=False, max_items_per_user=max_items_per_user,
+                                          max_users_per_movie=max_users_per_movie)
+    for count in workers:
+        with timer.stage("new", scoring_stage("cooccurrence scoring", count)):
+            program.recommend_all('cooccurrence', top_n, workers=count)
+    with timer.stage("new", "user similarity"):
+        program.do_user_based_cos_similarity_algorithm(top_k=similar_top_k, top_n=top_n, score_users=False)
+    for count in workers:
+        with timer.stage("new", scoring_stage("user-based scoring", count)):
+            program.recommend_all('user_based_cos_similarity', top_n, workers=count)
+    if item_based:
+        with timer.stage("new", "item similarity"):
+            program.do_item_based_cos_similarity_algorithm(top_k=item_top_k, top_n=top_n, score_users=False)
+        with timer.stage("new", "item-based scoring"):
+            program.recommend_all('item_based_cos_similarity', top_n)
+    if als:
+        with timer.stage("new", "als factors"):
+            program.do_als_algorithm(top_n=top_n, score_users=False)
+        with timer.stage("new", "als scoring"):
+            program.recommend_all('als', top_n)
+
+
+def scoring_stage(name, workers):
+    return name if workers is None else "%s x%d" % (name, workers)
+
+
+def benchmark_legacy(timer, data):
+    """time the stages of movie_recommendation_system.py on the ratings text data"""
+    legacy = importlib.reload(importlib.import_module("movie_recommendation_system"))
+    stdin = sys.stdin
+    sys.stdin = io.StringIO(data)
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            with timer.stage("legacy", "ingest + matrix build"):
+                legacy.init_data()
+            with timer.stage("legacy", "cooccurrence"):
+                legacy.cooccurrence_matrix()
+            with timer.stage("legacy", "user-based"):
+                legacy.user_based()
+    finally:
+        sys.stdin = stdin
+
+
+def show_stages(stages):
+    print("%-8s %-26s %10s %10s" % ("program", "stage", "seconds", "peak MB"))
+    for stage in stages:
+        peak_mb = "-" if stage["peak_mb"] is None else "%.1f" % stage["peak_mb"]
+        print("%-8s %-26s %10.3f %10s" % (stage["program"], stage["stage"], stage["seconds"], peak_mb))
+    print("cpus: %d" % len(os.sched_getaffinity(0)))
+    # ru_maxrss is in kilobytes on linux
+    print("max resident memory: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def add_generator_args(parser):
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--movies", type=int, default=500)
+    parser.add_argument("--density", type=float, default=0.02,
+                        help="share of the users x movies pairs that are rated")
+    parser.add_argument("--popularity", type=float, default=1.0,
+                        help="power-law exponent of movie popularity, 0 for uniform")
+    parser.add_argument("--activity", type=float, default=0.5,
+                        help="power-law exponent of user activity, 0 for uniform")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Synthetic ratings and stage timings of the recommenders")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate = commands.add_parser("generate", help="write synthetic ratings to stdout")
+    add_generator_args(generate)
+    run = commands.add_parser("run", help="time every stage of the recommenders")
+    add_generator_args(run)
+    run.add_argument("--input", metavar="PATH",
+                     help="read the ratings from this file instead of generating them")
+    run.add_argument("--programs", nargs="+", choices=["new", "legacy"], default=["new", "legacy"])
+    run.add_argument("--top-n", type=int, default=None)
+    run.add_argument("--similar-top-k", type=int, default=None)
+    run.add_argument("--item-based", action="store_true")
+    run.add_argument("--item-top-k", type=int, default=50)
+    run.add_argument("--als", action="store_true")
+    run.add_argument("--workers", type=int, nargs="+", default=None, metavar="N",
+                     help="time the scoring stages with every one of these worker process counts, 0 scores here")
+    run.add_argument("--max-items-per-user", type=int, default=None)
+    run.add_argument("--max-users-per-movie", type=int, default=None)
+    run.add_argument("--no-trace-memory", action="store_true",
+                     help="skip tracemalloc, it slows down the pure python stages")
+    run.add_argument("--json", metavar="PATH", help="also write the stage timings to this json file")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == "generate":
+        write_ratings(sys.stdout, *generate_ratings(args.users, args.movies, args.density, args.popularity,
+                                                    args.activity, args.seed))
+        sys.exit(0)
+
+    if args.input:
+        with open(args.input) as f:
+            data = f.read()
+    else:
+        text = io.StringIO()
+        write_ratings(text, *generate_ratings(args.users, args.movies, args.density, args.popularity,
+                                              args.activity, args.seed))
+        data = text.getvalue()
+    timer = StageTimer(not args.no_trace_memory)
+    if timer.trace_memory:
+        tracemalloc.start()
+    if "new" in args.programs:
+        benchmark_new(timer, data, args.top_n, args.similar_top_k, args.item_based, args.max_items_per_user,
+                      args.max_users_per_movie, args.als,
+                      [count or None for count in args.workers] if args.workers else (None,), args.item_top_k)
+    if "legacy" in args.programs:
+        benchmark_legacy(timer, data)
+    show_stages(timer.stages)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"ratings": data.count("\n"), "cpus": len(os.sched_getaffinity(0)), "stages": timer.stages},
+                      f, indent=2)
@@ -1,13 +1,18 @@
-#!/opt/python-3.4/linux/bin/python3
+#!/usr/bin/env python3
+# needs python 3.5+ and numpy 1.17+ for numpy.random.default_rng
 
+import heapq
 import re
 import sys
 from collections import defaultdict
 
 import numpy
-from scipy import spatial
+from scipy import sparse
 
 class Movie(object):
+    # one Movie per rating line, slots keep it to the two fields without a __dict__
+    __slots__ = ('movie_id', 'rating')
+
     def __init__(self, movie_id, rating):
         self.movie_id = movie_id
         self.rating = rating
@@ -22,6 +27,9 @@ users_count = 0
 min_movie_id = sys.maxsize
 max_movie_id = 0
 movies_count = 0
+rating_matrix = None  # csr_matrix (user_id - min_user_id, movie_id - min_movie_id) = rating
+rating_matrix_csc = None  # the same non-zero ratings, stored column by column
+watched_matrix = None  # csr_matrix with how many times a user rated a movie, 0.0 ratings included
 
 
 def error(message):
@@ -55,13 +63,18 @@ def is_valid(data):
 
 
 
-def init_data():
+def init_data(rating_dtype=numpy.float64, count_dtype=numpy.int64):
+    """read the ratings from stdin, the rating and similarity matrices are rating_dtype and the
+    watched and cooccurrence counts count_dtype, float32 and int32 halve them"""
     global min_user_id
     global max_user_id
     global users_count
     global min_movie_id
     global max_movie_id
     global movies_count
+    global rating_matrix
+    global rating_matrix_csc
+    global watched_matrix
     for line in sys.stdin:
         orig_line = line
         matchObj = re.match("(.*?)#.*", line)  # using regex to remove comment
@@ -82,93 +95,160 @@ def init_data():
         movies[movie_id].append(user_id)
     users_count = max_user_id - min_user_id + 1
     movies_count = max_movie_id - min_movie_id + 1
-
-
-
-def cooccurrence_matrix():
-    """cooccurrence recommender algorithm"""
-    # step1: calculate cooccurrence matrix
-    matrix = numpy.zeros((movies_count, movies_count))
-    recommendation = [0] * users_count
+    # build sparse rating matrix once, the later rating of a (user, movie) pair wins
+    ratings = dict()
     for user in users:
-        movie = users[user]
-        n = len(movie)
-        for i in range(n):
-            for j in range(i, n):
-                if movie[i].movie_id == movie[j].movie_id:
-                    matrix[movie[i].movie_id - min_movie_id][movie[j].movie_id - min_movie_id] += 1
-                else:
-                    matrix[movie[i].movie_id - min_movie_id][movie[j].movie_id - min_movie_id] += 1
-                    matrix[movie[j].movie_id - min_movie_id][movie[i].movie_id - min_movie_id] += 1
+        for movie in users[user]:
+            ratings[(user - min_user_id, movie.movie_id - min_movie_id)] = movie.rating
+    rows = [key[0] for key in ratings]
+    cols = [key[1] for key in ratings]
+    rating_matrix = sparse.csr_matrix((list(ratings.values()), (rows, cols)),
+                                      shape=(users_count, movies_count), dtype=rating_dtype)
+    # duplicated (user, movie) lines are summed up, so a movie rated twice counts twice
+    watched_rows = [user - min_user_id for user in users for movie in users[user]]
+    watched_cols = [movie.movie_id - min_movie_id for user in users for movie in users[user]]
+    watched_matrix = sparse.csr_matrix((numpy.ones(len(watched_rows), dtype=count_dtype),
+                                        (watched_rows, watched_cols)),
+                                       shape=(users_count, movies_count))
+    rating_matrix.eliminate_zeros()
+    rating_matrix_csc = rating_matrix.tocsc()
+
+
+
+def cap_rows(matrix, limit, seed=0):
+    """copy of the csr matrix keeping a random sample of at most limit entries of every row"""
+    counts = numpy.diff(matrix.indptr)
+    random = numpy.random.default_rng(seed)
+    rows = numpy.repeat(numpy.arange(matrix.shape[0]), counts)
+    order = numpy.lexsort((random.random(matrix.nnz), rows))
+    rank = numpy.empty(matrix.nnz, dtype=numpy.int64)
+    rank[order] = numpy.arange(matrix.nnz) - matrix.indptr[rows[order]]
+    keep = rank < limit
+    indptr = numpy.concatenate([[0], numpy.cumsum(numpy.minimum(counts, limit))])
+    return sparse.csr_matrix((matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
+
+
+def cooccurrence_matrix(sparse_output=False, top_n=1, max_items_per_user=None):
+    """cooccurrence recommender algorithm, keep the cooccurrence matrix sparse if sparse_output,
+    with top_n > 1 recommend a list of the top_n movies of every user, with max_items_per_user
+    a heavy user's cooccurrences are counted on a sample of that many of their movies"""
+    # step1: calculate cooccurrence matrix, A.T * A with A the binary user-movie matrix
+    counted = watched_matrix
+    if max_items_per_user is not None:
+        counted = cap_rows(watched_matrix, max_items_per_user)
+        print("Cooccurrence counted with %d of %d pair updates."
+              % ((numpy.diff(counted.indptr) ** 2).sum(), (numpy.diff(watched_matrix.indptr) ** 2).sum()))
+    matrix = (counted.T.tocsr() * counted).tocsr()
+    # pairs of the same movie were counted once per (i <= j) pair of its c ratings
+    diagonal = numpy.zeros(movies_count, dtype=watched_matrix.dtype)
+    numpy.add.at(diagonal, counted.indices, counted.data * (counted.data + 1) // 2)
+    matrix.setdiag(diagonal)
+    if not sparse_output:
+        matrix = matrix.toarray()
+    recommendation = [0] * users_count if top_n == 1 else [[] for _ in range(users_count)]
     # step2: multiplying cooccurrence matrix with user's rating vector to produce a
     # weight vector that lead to recommendation, choose the weight user doesn't
     # have and with highest values in the weight vector
     for user in users:
-        user_rating = [0.0] * movies_count
+        user_rating = rating_matrix[user - min_user_id].toarray().ravel()
         movie_set = set()
         for movie in users[user]:
-            user_rating[movie.movie_id - min_movie_id] = movie.rating
             movie_set.add(movie.movie_id)
         weights = matrix.dot(user_rating)
-        max_weight = 0
-        for i in range(movies_count):
-            if (i + min_movie_id) not in movie_set and weights[i] > max_weight:
-                max_weight = weights[i]
-                recommendation[user - min_user_id] = i + min_movie_id
+        # bounded heap of the top_n weights, on ties the smaller movie id wins
+        candidates = [i for i in range(movies_count) if (i + min_movie_id) not in movie_set and weights[i] > 0]
+        best = [i + min_movie_id for i in heapq.nlargest(top_n, candidates, key=weights.__getitem__)]
+        if top_n > 1:
+            recommendation[user - min_user_id] = best
+        elif best:
+            recommendation[user - min_user_id] = best[0]
     print("=" * 40)
     print("Coocurrence recommender algorithm: ")
-    for i in range(users_count):
-        print("for user %s, recommend movie %s" % (i + min_user_id, recommendation[i]))
+    # one write for all users instead of one print per user
+    sys.stdout.write("".join("for user %s, recommend movie %s\n" % (i + min_user_id, recommendation[i])
+                             for i in range(users_count)))
     print("=" * 40+ "\n")
 
 
-def user_based():
-    """User_based recommendation algorithm"""
-    recommendation = [0] * users_count
+def cosine_similarity_matrix(top_k=None, block_size=1024):
+    """cosine similarity of every two users, users' rating rows are normalized once and
+    multiplied block by block; with top_k keep only the k most similar other users of
+    every user in a csr_matrix instead of the dense users x users matrix"""
+    norms = numpy.sqrt(numpy.asarray(rating_matrix.multiply(rating_matrix).sum(axis=1)).ravel())
+    scale = numpy.zeros(users_count, dtype=rating_matrix.dtype)
+    scale[norms > 0] = 1 / norms[norms > 0]
+    normalized = sparse.diags(scale).dot(rating_matrix).tocsr()
+    normalized_t = normalized.T.tocsr()
+    if top_k is None:
+        similar_matrix = numpy.zeros((users_count, users_count), dtype=rating_matrix.dtype)
+    else:
+        top_k = min(top_k, max(users_count - 1, 0))
+        rows, cols, values = [], [], []
+    for start in range(0, users_count, block_size):
+        end = min(start + block_size, users_count)
+        block = normalized[start:end].dot(normalized_t).toarray()
+        block_rows = numpy.arange(start, end)
+        if top_k is None:
+            block[block_rows - start, block_rows] = norms[start:end] > 0
+            similar_matrix[start:end] = block
+        elif top_k > 0:
+            block[block_rows - start, block_rows] = 0
+            block_cols = numpy.argpartition(-block, top_k - 1, axis=1)[:, :top_k]
+            block_values = numpy.take_along_axis(block, block_cols, axis=1)
+            keep = block_values > 0
+            rows.append(numpy.repeat(block_rows, top_k)[keep.ravel()])
+            cols.append(block_cols[keep])
+            values.append(block_values[keep])
+    if top_k is None:
+        return similar_matrix
+    if not rows:
+        return sparse.csr_matrix((users_count, users_count))
+    return sparse.csr_matrix((numpy.concatenate(values), (numpy.concatenate(rows), numpy.concatenate(cols))),
+                             shape=(users_count, users_count))
+
+
+def user_based(top_k=None, block_size=1024, top_n=1):
+    """User_based recommendation algorithm, with top_k only the k most similar users count,
+    with top_n > 1 recommend a list of the top_n movies of every user"""
+    recommendation = [0] * users_count if top_n == 1 else [[] for _ in range(users_count)]
     # step1: using cosine_similarity to calculate similar matrix
-    similar_matrix = numpy.zeros((users_count, users_count))
-    rating_matrix = numpy.zeros((users_count, movies_count))
-    for user in users:
-        for movie in users[user]:
-            rating_matrix[user - min_user_id][movie.movie_id - min_movie_id] = movie.rating
-    for i in range(users_count):
-        for j in range(i, users_count):
-            if sum(rating_matrix[i]) == 0.0 or sum(rating_matrix[j]) == 0.0:
-                continue
-            elif i == j:
-                similar_matrix[i][j] = 1
-            else:
-                curr = 1 - spatial.distance.cosine(rating_matrix[i], rating_matrix[j])
-                similar_matrix[i][j] = curr
-                similar_matrix[j][i] = curr
-    # step2: naive and slow algorithm
+    similar_matrix = cosine_similarity_matrix(top_k, block_size)
+    # step2: naive and slow algorithm, only the users who rated a movie are visited
     for user in users:
         movie_set = set()
-        max_weight = 0
+        average_weights = dict()
         for movie in users[user]:
             movie_set.add(movie.movie_id)
+        similar_row = similar_matrix[user - min_user_id]
+        if sparse.issparse(similar_row):
+            similar_row = similar_row.toarray().ravel()
         for movie in movies:
             if movie not in movie_set:
-                weight = 0
-                count = 0
-                for i in range(users_count):
-                    if rating_matrix[i][movie - min_movie_id] != 0:
-                        weight += rating_matrix[i][movie - min_movie_id] * similar_matrix[i][user - min_user_id]
-                        count += 1
-                average_weight = weight / count
-                if average_weight > max_weight:
-                    max_weight = average_weight
-                    recommendation[user - min_user_id] = movie
+                start = rating_matrix_csc.indptr[movie - min_movie_id]
+                end = rating_matrix_csc.indptr[movie - min_movie_id + 1]
+                raters = rating_matrix_csc.indices[start:end]
+                weight = rating_matrix_csc.data[start:end].dot(similar_row[raters])
+                count = end - start
+                average_weight = weight / count if count != 0 else 0
+                if average_weight > 0:
+                    average_weights[movie] = average_weight
+        # bounded heap of the top_n weights, on ties the movie read first wins
+        best = heapq.nlargest(top_n, average_weights, key=average_weights.__getitem__)
+        if top_n > 1:
+            recommendation[user - min_user_id] = best
+        elif best:
+            recommendation[user - min_user_id] = best[0]
     print("=" * 40)
     print("User-based: recommendation: ")
-    for i in range(users_count):
-            print("for user %s, recommend movie %s" % (i + min_user_id, recommendation[i]))
+    # one write for all users instead of one print per user
+    sys.stdout.write("".join("for user %s, recommend movie %s\n" % (i + min_user_id, recommendation[i])
+                             for i in range(users_count)))
     print("=" * 40 + "\n")
 
 
 
-def run():
-    init_data()
+def run(rating_dtype=numpy.float64, count_dtype=numpy.int64):
+    init_data(rating_dtype, count_dtype)
     cooccurrence_matrix()
     user_based()
 
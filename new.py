@@ -1,38 +1,1267 @@
-#!/opt/python-3.4/linux/bin/python3
+#!/usr/bin/env python3
+# needs python 3.8+: asyncio.run for --serve, multiprocessing.shared_memory for --workers
 
+import argparse
+import asyncio
+import contextlib
+import cProfile
+import hashlib
+import json
+import multiprocessing
+import os
 import re
+import resource
+import struct
 import sys
-from collections import defaultdict
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
-from scipy import spatial
+from scipy import sparse
+
+try:
+    import pymongo
+except ImportError:  # only the MongoDB ratings source needs it
+    pymongo = None
+
+
+# byte classes used by parse_rating_lines, a "token" is a run of digits and dots
+TOKEN, SPACE, COMMA, HASH, OTHER, NEWLINE = range(6)
+BYTE_KIND = numpy.full(256, OTHER, dtype=numpy.uint8)
+BYTE_KIND[list(b"0123456789.")] = TOKEN
+BYTE_KIND[list(b" \t\r\x0b\x0c")] = SPACE
+BYTE_KIND[ord(",")] = COMMA
+BYTE_KIND[ord("#")] = HASH
+BYTE_KIND[ord("\n")] = NEWLINE
+RATING_LINE_KINDS = [TOKEN, COMMA, TOKEN, COMMA, TOKEN]
+MAX_ID = int(numpy.iinfo(numpy.int64).max) # ids are kept as int64
+
+SNAPSHOT_MAGIC = b"MRSNAP01"
+RECOMMENDATIONS_MAGIC = b"MRRECS01"
+SNAPSHOT_ALIGN = 64
+RATING_STEPS = 50 # a uint8 ratings table keeps round(rating * RATING_STEPS), exact for 0.02 steps up to 5.1
+MATRIX_CACHE_VERSION = "1" # part of every matrix cache key, change it when a cached matrix changes meaning
+
+# dtypes of the ratings table, the rating matrices and the cooccurrence counts by --storage;
+# indices None leaves the index dtype to scipy, counts are narrowed only when the largest one fits
+STORAGE_MODES = {'float64': {'ratings_table': numpy.float64, 'ratings': numpy.float64, 'watched': numpy.int64,
+                             'counts': numpy.int64, 'indices': None},
+                 'float32': {'ratings_table': numpy.float64, 'ratings': numpy.float32, 'watched': numpy.int32,
+                             'counts': numpy.int32, 'indices': numpy.int32},
+                 'compact': {'ratings_table': numpy.uint8, 'ratings': numpy.float32, 'watched': numpy.int32,
+                             'counts': numpy.uint16, 'indices': numpy.int32}}
+
+# BSON element types of the numbers a ratings document holds, and the bytes of the other
+# fixed size values, see bson_elements
+BSON_NUMBERS = {0x01: numpy.dtype("<f8"), 0x10: numpy.dtype("<i4"), 0x12: numpy.dtype("<i8")}
+BSON_FIXED_SIZES = {0x01: 8, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16,
+                    0x7F: 0, 0xFF: 0}
+
+worker_program = None # MovieRecommendationProgram over the shared matrices in a pool worker
 
 
 def error(message):
     print(message)
 
 
+def parse_rating_lines(data):
+    """vectorized parse of the bytes of complete "user_id, movie_id, rating # comment" lines
+
+    returns (parsed, user_ids, movie_ids, ratings), parsed is a boolean mask over the
+    lines of data. Only plain lines (digit ids, a rating with at most one decimal point,
+    spaces and a comment) are parsed here, the others are left to the per-line rules
+    """
+    if not data.endswith(b"\n"):
+        data += b"\n"
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    token = ((buf - 48) <= 9) | (buf == 46)
+    space = (buf == 32) | (((buf - 9) <= 4) & (buf != 10))
+
+    # step1: keep one "event" per token, comma, hash, newline or other byte and check
+    # that every line starts with token, comma, token, comma, token then ends or a comment
+    event = ~(token | space)
+    event[1:] |= token[1:] & ~token[:-1]
+    event[0] |= token[0]
+    positions = numpy.flatnonzero(event)
+    kinds = BYTE_KIND[buf[positions]]
+    line_last = numpy.flatnonzero(kinds == NEWLINE)
+    line_first = numpy.concatenate([[0], line_last[:-1] + 1])
+    candidates = numpy.flatnonzero(line_last - line_first >= 5)
+    first = line_first[candidates]
+    good = (kinds[first + 5] == NEWLINE) | (kinds[first + 5] == HASH)
+    for k, kind in enumerate(RATING_LINE_KINDS):
+        good &= kinds[first + k] == kind
+    parsed = numpy.zeros(len(line_last), dtype=bool)
+    parsed[candidates[good]] = True
+
+    # step2: read the three tokens of every good line digit by digit, all lines at once
+    first = first[good]
+    starts = numpy.empty(3 * len(first), dtype=numpy.int64)
+    for k in range(3):
+        starts[k::3] = positions[first + 2 * k]
+    values = numpy.zeros(len(starts), dtype=numpy.int64)
+    digits = numpy.zeros(len(starts), dtype=numpy.int32)
+    decimals = numpy.zeros(len(starts), dtype=numpy.int32)
+    dots = numpy.zeros(len(starts), dtype=numpy.int32)
+    active = numpy.ones(len(starts), dtype=bool)
+    for column in range(19):
+        chars = buf[numpy.minimum(starts + column, len(buf) - 1)]
+        is_dot = active & (chars == 46)
+        is_digit = active & ((chars - 48) <= 9)
+        active = is_digit | is_dot
+        if not active.any():
+            break
+        values = numpy.where(is_digit, values * 10 + (chars - 48), values)
+        digits += is_digit
+        decimals += is_digit & (dots > 0)
+        dots += is_dot
+
+    # ids have 1 to 18 digits, ratings 1 to 15 digits and maybe one decimal point
+    rating_token = numpy.arange(len(starts)) % 3 == 2
+    bad = active | (digits == 0) | (dots > rating_token) | (digits > numpy.where(rating_token, 15, 18))
+    bad = bad.reshape(-1, 3).any(axis=1)
+    parsed[numpy.flatnonzero(parsed)[bad]] = False
+    values = values.reshape(-1, 3)[~bad]
+    decimals = decimals.reshape(-1, 3)[~bad]
+    # both integers are exact, so the division rounds like float() of the text does
+    return parsed, values[:, 0], values[:, 1], values[:, 2] / 10.0 ** decimals[:, 2]
+
+
+def bson_document_starts(batch):
+    """(start offset, length) arrays of the documents of a raw BSON batch
+
+    every document starts with its int32 length; when every document is as long as the
+    first, the lengths are read as one strided view, else the documents are walked
+    """
+    size = len(batch)
+    if size < 4:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    first = int.from_bytes(batch[:4], "little")
+    if first >= 5 and size % first == 0:
+        lengths = numpy.ndarray((size // first,), dtype="<i4", buffer=batch, strides=(first,))
+        if (lengths == first).all():
+            return numpy.arange(0, size, first, dtype=numpy.int64), lengths.astype(numpy.int64)
+    starts, lengths = [], []
+    position = 0
+    while position < size:
+        length = int.from_bytes(batch[position:position + 4], "little")
+        if length < 5 or position + length > size:
+            raise ValueError("broken BSON document at byte %d of a batch" % position)
+        starts.append(position)
+        lengths.append(length)
+        position += length
+    return numpy.array(starts, dtype=numpy.int64), numpy.array(lengths, dtype=numpy.int64)
+
+
+def bson_elements(document):
+    """[(name, type, value offset, value size)] of the top level elements of one BSON document"""
+    elements = []
+    position = 4
+    while position < len(document) - 1:
+        element_type = document[position]
+        name_end = document.index(b"\x00", position + 1)
+        name = document[position + 1:name_end].decode(errors="replace")
+        offset = name_end + 1
+        if element_type in BSON_FIXED_SIZES:
+            size = BSON_FIXED_SIZES[element_type]
+        elif element_type in (0x02, 0x0D, 0x0E):  # string, code, symbol: int32 length + bytes
+            size = 4 + int.from_bytes(document[offset:offset + 4], "little")
+        elif element_type in (0x03, 0x04, 0x0F):  # document, array, code with scope: int32 total length
+            size = int.from_bytes(document[offset:offset + 4], "little")
+        elif element_type == 0x05:  # binary: int32 length, subtype, bytes
+            size = 5 + int.from_bytes(document[offset:offset + 4], "little")
+        elif element_type == 0x0B:  # regex: two cstrings
+            size = document.index(b"\x00", document.index(b"\x00", offset) + 1) + 1 - offset
+        else:
+            raise ValueError("unsupported BSON element type 0x%02x" % element_type)
+        elements.append((name, element_type, offset, size))
+        position = offset + size
+    return elements
+
+
+def bson_value(document, element_type, offset, size):
+    """python value of a number element, a short text for any other element"""
+    if element_type in BSON_NUMBERS:
+        return numpy.frombuffer(document, dtype=BSON_NUMBERS[element_type], count=1, offset=offset)[0].item()
+    if element_type == 0x02:
+        return document[offset + 4:offset + size - 1].decode(errors="replace")
+    return "<BSON type 0x%02x>" % element_type
+
+
+def rating_values_reason(fields, values):
+    """the error message why (user_id, movie_id, rating) values of a document are invalid, None if valid
+
+    the rules of invalid_reason: ids are integers from 0 up to MAX_ID, a number with no
+    fraction counts as one, the rating is a number from 0.0 to 5.0
+    """
+    for name, label, value in zip(fields[:2], ("user_id", "movie_id"), values[:2]):
+        if value is None:
+            return "Invalid data: %s field '%s' is missing." % (label, name)
+        # nan fails both bounds, inf and huge doubles the upper one, before int() could overflow
+        if isinstance(value, str) or not value >= 0:
+            return "Invalid data: %s '%s' is not an integer." % (label, value)
+        if value > MAX_ID:
+            return "Invalid data: %s '%s' is out of range." % (label, value)
+        if value != int(value):
+            return "Invalid data: %s '%s' is not an integer." % (label, value)
+    rating = values[2]
+    if rating is None:
+        return "Invalid data: rating field '%s' is missing." % fields[2]
+    if isinstance(rating, str):
+        return "Invalid data: rating '%s' is not a floating." % rating
+    if rating != rating:
+        return "Invalid data: rating '%s' is not a number." % rating
+    if rating < 0 or rating > 5:
+        return "Invalid data: rating '%s' is out of range." % rating
+    return None
+
+
+def parse_bson_ratings(batch, fields=("user_id", "movie_id", "rating"), first_number=0, invalid=None):
+    """(user_ids, movie_ids, ratings) arrays of a raw BSON batch of ratings documents, in batch order
+
+    documents of the same length and layout, i.e. the same element types and names at
+    the same offsets, are read together: their bytes are gathered into one (documents,
+    length) array and every field is one column slice viewed as its number dtype. A
+    projected find gives one or a few layouts per batch, e.g. int32 and double ratings.
+    The other documents and the values outside the rules of rating_values_reason are
+    checked one by one; (document number, message, fields text) of every invalid document
+    is appended to invalid, documents are numbered from first_number
+    """
+    view = numpy.frombuffer(batch, dtype=numpy.uint8)
+    starts, lengths = bson_document_starts(batch)
+    columns = [numpy.zeros(len(starts), dtype=numpy.int64), numpy.zeros(len(starts), dtype=numpy.int64),
+               numpy.zeros(len(starts), dtype=numpy.float64)]
+    valid = numpy.zeros(len(starts), dtype=bool)
+    one_by_one = []
+    for length in numpy.unique(lengths).tolist():
+        group = numpy.flatnonzero(lengths == length)
+        if len(group) == len(starts):
+            documents = view.reshape(-1, length)  # one layout, no copy
+        else:
+            documents = view[starts[group][:, None] + numpy.arange(length)]
+        try:
+            elements = {name: (element_type, offset, size)
+                        for name, element_type, offset, size in bson_elements(documents[0].tobytes())}
+        except (ValueError, IndexError):
+            one_by_one.extend(group.tolist())
+            continue
+        # every byte outside the values of the wanted fields must match the first document
+        layout = numpy.ones(length, dtype=bool)
+        for name in fields:
+            if name in elements:
+                element_type, offset, size = elements[name]
+                layout[offset:offset + size] = False
+        layout[:4] = False
+        same = (documents[:, layout] == documents[0, layout]).all(axis=1)
+        one_by_one.extend(group[~same].tolist())
+        group, documents = group[same], documents[same]
+        if not all(name in elements and elements[name][0] in BSON_NUMBERS for name in fields):
+            one_by_one.extend(group.tolist())
+            continue
+        fits = numpy.ones(len(group), dtype=bool)
+        for k, (column, name) in enumerate(zip(columns, fields)):
+            element_type, offset, size = elements[name]
+            values = numpy.ascontiguousarray(documents[:, offset:offset + size]).view(
+                BSON_NUMBERS[element_type]).ravel()
+            if k < 2 and element_type == 0x01:
+                # a double id has to be a whole number below 2 ** 63, the others are not cast to int64
+                whole = (values == numpy.floor(values)) & (values >= 0) & (values < 2.0 ** 63)
+                fits &= whole
+                values = numpy.where(whole, values, 0)
+            column[group] = values
+        user_ids, movie_ids, ratings = (column[group] for column in columns)
+        fits &= (ratings >= 0) & (ratings <= 5) & (user_ids >= 0) & (movie_ids >= 0)
+        valid[group[fits]] = True
+        one_by_one.extend(group[~fits].tolist())
+
+    for i in sorted(one_by_one):
+        document = batch[starts[i]:starts[i] + lengths[i]]
+        try:
+            found = {name: bson_value(document, element_type, offset, size)
+                     for name, element_type, offset, size in bson_elements(document) if name in fields}
+        except (ValueError, IndexError) as e:
+            message, found = "Invalid data: %s." % e, {}
+        else:
+            message = rating_values_reason(fields, [found.get(name) for name in fields])
+        if message:
+            if invalid is not None:
+                text = ", ".join("%s: %s" % (name, found[name]) for name in fields if name in found)
+                invalid.append((first_number + i, message, "{%s}" % text))
+            continue
+        for column, name in zip(columns, fields):
+            column[i] = found[name]
+        valid[i] = True
+    return tuple(column[valid] for column in columns)
+
+
+class MongoRatingsSource(object):
+    """ratings documents of a MongoDB collection read as raw BSON batches, see parse_bson_ratings
+
+    every document holds a user id, a movie id and a rating under the names of fields,
+    the cursors project only those and hand over whole batches of raw BSON, so no document
+    becomes a Python dict. With partitions the user ids are split into that many ranges
+    read by as many cursors at once, the documents whose user id is not a number, or nan,
+    are read by one more cursor so they are reported as invalid. A later rating of a
+    (user, movie) wins in cursor order, the ranges keep all ratings of a user in one cursor
+    """
+
+    def __init__(self, uri="mongodb://localhost:27017", database="test_database", collection="ratings",
+                 fields=("user_id", "movie_id", "rating"), query=None, batch_size=50000, partitions=1):
+        if pymongo is None:
+            raise ImportError("reading ratings from MongoDB needs pymongo, pip install pymongo")
+        self.client = pymongo.MongoClient(uri)
+        self.collection = self.client[database][collection]
+        self.fields = tuple(fields) # names of the user id, movie id and rating fields
+        self.query = query or {} # only the documents matching this filter are read
+        self.batch_size = batch_size # documents of every raw batch the server sends
+        self.partitions = partitions # cursors reading user id ranges at once
+
+    def filters(self):
+        """[(label, filter)] of every cursor, (None, query) for all documents or one per user id range
+
+        the first and last ranges are open, so ids beyond the int64 cuts are read too
+        """
+        if self.partitions <= 1:
+            return [(None, self.query)]
+        user_field = self.fields[0]
+        bounds = []
+        for direction in (pymongo.ASCENDING, pymongo.DESCENDING):
+            # every number is from -inf up, but nan is not, it sorts before them
+            first = list(self.collection.find({"$and": [self.query, {user_field: {"$gte": float("-inf")}}]},
+                                              {user_field: 1, "_id": 0}).sort(user_field, direction).limit(1))
+            bounds.append(first[0][user_field] if first else None)
+        filters = []
+        if bounds[0] is not None:
+            low, high = (int(min(max(numpy.floor(bound), -2.0 ** 62), 2.0 ** 62)) for bound in bounds)
+            cuts = sorted(set(low + (high + 1 - low) * k // self.partitions for k in range(self.partitions + 1)))
+            for start, stop in zip([None] + cuts[1:-1], cuts[1:-1] + [None]):
+                condition = {"$gte": float("-inf") if start is None else start}
+                if stop is not None:
+                    condition["$lt"] = stop
+                label = "%s in [%s, %s)" % (user_field, condition["$gte"], "inf" if stop is None else stop)
+                filters.append((label, {"$and": [self.query, {user_field: condition}]}))
+        not_numbers = {"$or": [{user_field: {"$not": {"$type": "number"}}}, {user_field: float("nan")}]}
+        filters.append(("%s not a number" % user_field, {"$and": [self.query, not_numbers]}))
+        return filters
+
+    def read_cursor(self, label, query):
+        """(user_ids, movie_ids, ratings, [(document number, message, fields text)], documents) of one cursor
+
+        documents are numbered in cursor order, with the label of the cursor if it has one
+        """
+        projection = dict({name: 1 for name in self.fields}, _id=0)
+        columns, invalid = [], []
+        documents = 0
+        for batch in self.collection.find_raw_batches(query, projection, batch_size=self.batch_size):
+            columns.append(parse_bson_ratings(batch, self.fields, documents, invalid))
+            documents += len(bson_document_starts(batch)[0])
+        if label is not None:
+            invalid = [("%s of the %s cursor" % (number, label), message, text) for number, message, text in invalid]
+        if not columns:
+            columns = [(numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0))]
+        return tuple(numpy.concatenate(column) for column in zip(*columns)) + (invalid, documents)
+
+    def read(self):
+        """(user_ids, movie_ids, ratings, invalid, documents) of every cursor together, in range order
+
+        the cursors run on threads, pymongo waits for the server and numpy parses
+        without holding the GIL for long; invalid documents are numbered per cursor and
+        named with its user id range then, see read_cursor
+        """
+        filters = self.filters()
+        if len(filters) > 1:
+            with ThreadPoolExecutor(len(filters)) as executor:
+                parts = list(executor.map(self.read_cursor, *zip(*filters)))
+        else:
+            parts = [self.read_cursor(*filters[0])]
+        user_ids, movie_ids, ratings = (numpy.concatenate([part[k] for part in parts]) for k in range(3))
+        invalid = [entry for part in parts for entry in part[3]]
+        return user_ids, movie_ids, ratings, invalid, sum(part[4] for part in parts)
+
+
+def save_columns(path, **columns):
+    """write numpy arrays as columns of a binary file that load_columns can memory-map
+
+    the file is SNAPSHOT_MAGIC, the length of a json header describing every column,
+    the header, then every column at a SNAPSHOT_ALIGN aligned offset. Keyword values
+    that are not arrays are stored in the header as they are
+    """
+    header = {"columns": {}}
+    arrays = []
+    size = 0
+    for name, value in columns.items():
+        if not isinstance(value, numpy.ndarray):
+            header[name] = value
+            continue
+        value = numpy.ascontiguousarray(value)
+        header["columns"][name] = {"dtype": value.dtype.str, "length": len(value), "offset": size}
+        arrays.append((size, value))
+        size += -(-value.nbytes // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    header = json.dumps(header).encode()
+    data_start = -(-(len(SNAPSHOT_MAGIC) + 8 + len(header)) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    with open(path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack("<Q", len(header)) + header)
+        for offset, value in arrays:
+            f.seek(data_start + offset)
+            f.write(value.tobytes())
+        f.truncate(data_start + size)
+
+
+def load_columns(path):
+    """read a file written by save_columns, return (header, {name: read-only memmap column})"""
+    with open(path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError("%s is not a ratings snapshot" % path)
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length))
+    data_start = -(-(len(SNAPSHOT_MAGIC) + 8 + header_length) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    columns = dict()
+    for name, column in header.pop("columns").items():
+        if column["length"] == 0:
+            columns[name] = numpy.zeros(0, dtype=column["dtype"])
+            continue
+        columns[name] = numpy.memmap(path, dtype=column["dtype"], mode="r",
+                                     offset=data_start + column["offset"], shape=(column["length"],))
+    return header, columns
+
+
+def save_matrices(path, matrices):
+    """write {name: ndarray or sparse matrix} with save_columns, see load_matrices"""
+    header, columns = dict(), dict()
+    for name, matrix in matrices.items():
+        if sparse.issparse(matrix):
+            header[name] = {"format": matrix.format, "shape": list(matrix.shape)}
+            columns.update({name + ".data": matrix.data, name + ".indices": matrix.indices,
+                            name + ".indptr": matrix.indptr})
+        else:
+            header[name] = {"format": None, "shape": list(matrix.shape)}
+            columns[name] = numpy.asarray(matrix).ravel()
+    save_columns(path, matrices=header, **columns)
+
+
+def load_matrices(path):
+    """{name: matrix} of a save_matrices file, the matrices are read-only memory-mapped views"""
+    header, columns = load_columns(path)
+    matrices = dict()
+    for name, matrix in header["matrices"].items():
+        shape = tuple(matrix["shape"])
+        if matrix["format"] is None:
+            matrices[name] = columns[name].reshape(shape)
+        else:
+            parts = (columns[name + ".data"], columns[name + ".indices"], columns[name + ".indptr"])
+            matrices[name] = getattr(sparse, matrix["format"] + "_matrix")(parts, shape=shape, copy=False)
+    return matrices
+
+
+def writable(matrix):
+    """matrix, or a copy of it if it is a read-only memory-mapped one that is about to be changed"""
+    data = matrix.data if sparse.issparse(matrix) else matrix
+    return matrix if data.flags.writeable else matrix.copy()
+
+
+class MatrixCache(object):
+    """built matrices kept on disk under a hash of the ratings and the parameters they were built with
+
+    every entry is one save_matrices file named by its key, read back memory-mapped.
+    A read touches the file, the least recently used entries are removed once the
+    files take more than max_bytes
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, ratings_digest, algorithm, parameters):
+        """hex key of the matrices algorithm builds from the ratings with parameters"""
+        text = json.dumps([MATRIX_CACHE_VERSION, ratings_digest, algorithm, parameters], sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".mrsnap")
+
+    def load(self, key, names=()):
+        """{name: matrix} stored under key, None if there is no such entry
+
+        an entry that can not be read, e.g. a truncated or foreign file, or that lacks one
+        of names, is a miss and is removed
+        """
+        path = self.path(key)
+        try:
+            matrices = load_matrices(path)
+            missing = [name for name in names if name not in matrices]
+            if missing:
+                raise KeyError("no %s" % ", ".join(missing))
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            remove_file(path)
+            return None
+        return matrices
+
+    def store(self, key, matrices):
+        """save the matrices under key, then evict down to max_bytes; an entry larger than that is not kept
+
+        the file is written aside and renamed into place, so a run reading the cache
+        never sees half an entry
+        """
+        path = self.path(key)
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            save_matrices(temporary, matrices)
+        except BaseException:
+            remove_file(temporary)
+            raise
+        if os.path.getsize(temporary) > self.max_bytes:
+            os.remove(temporary)
+            return
+        os.replace(temporary, path)
+        self.evict()
+
+    def evict(self):
+        """remove the least recently used entries until the entries take at most max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".mrsnap"):
+                continue
+            try:
+                status = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+def share_matrices(matrices):
+    """copy {name: ndarray or sparse matrix} into shared memory, see attach_matrices
+
+    returns the shared memory blocks, to close and unlink once every worker is done,
+    and the specs another process passes to attach_matrices, they pickle to a few bytes
+    """
+    from multiprocessing import shared_memory  # python 3.8+, only the worker pool needs it
+    blocks, specs = [], dict()
+    for name, matrix in matrices.items():
+        if sparse.issparse(matrix):
+            matrix_format, parts = matrix.format, (matrix.data, matrix.indices, matrix.indptr)
+        else:
+            matrix_format, parts = None, (matrix,)
+        part_specs = []
+        for part in parts:
+            part = numpy.ascontiguousarray(part)
+            block = shared_memory.SharedMemory(create=True, size=max(part.nbytes, 1))
+            numpy.ndarray(part.shape, dtype=part.dtype, buffer=block.buf)[...] = part
+            blocks.append(block)
+            part_specs.append((block.name, part.shape, part.dtype.str))
+        specs[name] = (matrix_format, matrix.shape, part_specs)
+    return blocks, specs
+
+
+def attach_matrices(specs):
+    """(shared memory blocks, {name: matrix}) of share_matrices specs, the matrices are views
+
+    keep the blocks open as long as the matrices are used
+    """
+    from multiprocessing import shared_memory
+    blocks, matrices = [], dict()
+    for name, (matrix_format, shape, part_specs) in specs.items():
+        parts = []
+        for block_name, part_shape, dtype in part_specs:
+            block = shared_memory.SharedMemory(name=block_name)
+            blocks.append(block)
+            parts.append(numpy.ndarray(part_shape, dtype=dtype, buffer=block.buf))
+        if matrix_format is None:
+            matrices[name] = parts[0]
+        else:
+            matrices[name] = getattr(sparse, matrix_format + "_matrix")(tuple(parts), shape=shape, copy=False)
+    return blocks, matrices
+
+
+def init_worker(specs):
+    """pool initializer, attach the shared matrices to a bare program in this worker"""
+    global worker_program
+    blocks, matrices = attach_matrices(specs)
+    program = MovieRecommendationProgram.__new__(MovieRecommendationProgram)
+    for name, matrix in matrices.items():
+        setattr(program, name, matrix)
+    program.shared_blocks = blocks
+    worker_program = program
+
+
+def recommend_user_range(task):
+    """(start, [movie indices]) to recommend to the users start..stop, runs in a pool worker"""
+    algorithm, start, stop, top_n = task
+    user_rows = numpy.arange(start, stop)
+    scores = getattr(worker_program, worker_program.score_methods[algorithm])(user_rows)
+    return start, worker_program.select_recommendations(user_rows, scores, top_n)
+
+
+def encode_ratings(ratings, dtype):
+    """ratings as stored in a ratings table of dtype, a uint8 table keeps round(rating * RATING_STEPS)"""
+    if numpy.dtype(dtype) == numpy.uint8:
+        return numpy.round(numpy.asarray(ratings, dtype=numpy.float64) * RATING_STEPS).astype(numpy.uint8)
+    return numpy.asarray(ratings, dtype=dtype)
+
+
+def decode_ratings(data, dtype=numpy.float64):
+    """the ratings of a ratings table's data as dtype, see encode_ratings"""
+    if data.dtype == numpy.uint8:
+        return (data / RATING_STEPS).astype(dtype)
+    return data.astype(dtype)
+
+
+def narrow_counts(matrix, dtype):
+    """dense or sparse matrix of counts cast to dtype if its largest count fits, else left as it is"""
+    data = matrix.data if sparse.issparse(matrix) else matrix
+    if data.dtype == dtype or (data.size and data.max() > numpy.iinfo(dtype).max):
+        return matrix
+    return matrix.astype(dtype)
+
+
+def matrix_size(matrix):
+    """{'shape', 'nnz', 'bytes'} of a dense, sparse or blocked matrix, for the stage report"""
+    if isinstance(matrix, BlockedMatrix):
+        return {"shape": list(matrix.shape), "nnz": int(matrix.nnz),
+                "bytes": sum(os.path.getsize(block[2]) for block in matrix.blocks), "on_disk": True}
+    if sparse.issparse(matrix):
+        return {"shape": list(matrix.shape), "nnz": int(matrix.nnz),
+                "bytes": int(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes)}
+    return {"shape": list(matrix.shape), "nnz": int(numpy.count_nonzero(matrix)), "bytes": int(matrix.nbytes)}
+
+
+def peak_rss_mb():
+    """peak resident memory of this process so far, ru_maxrss is in kilobytes on linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def first_seen_order(ids):
+    """unique ids in order of first appearance, and the position of every id in that order"""
+    uniques, first, inverse = numpy.unique(ids, return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    position = numpy.empty(len(order), dtype=numpy.int64)
+    position[order] = numpy.arange(len(order))
+    return uniques[order].tolist(), position[inverse.ravel()]
+
+
+def cooccurrence_matrix(watched_matrix, sparse_output=False, dtype=None):
+    """count for every pair of movies how many users watched both of them
+
+    watched_matrix is the binary users x movies incidence matrix A, the result is
+    A.T * A, a movies x movies matrix, returned as csr_matrix if sparse_output is set.
+    With dtype the counts are narrowed to it when they fit, before a dense copy is made
+    """
+    matrix = (watched_matrix.T.tocsr() * watched_matrix).tocsr()
+    if dtype is not None:
+        matrix = narrow_counts(matrix, dtype)
+    if sparse_output:
+        return matrix
+    return matrix.toarray()
+
+
+def entry_keys(rows, cols, seed=0):
+    """pseudo random uint64 key of every (row, col) entry, the same for the same entry and seed"""
+    # splitmix64 finalizer over the packed entry position
+    keys = rows.astype(numpy.uint64) << numpy.uint64(32) | cols.astype(numpy.uint64)
+    keys = keys + numpy.uint64(0x9E3779B97F4A7C15 * (seed + 1) & 0xFFFFFFFFFFFFFFFF)
+    keys = (keys ^ (keys >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    keys = (keys ^ (keys >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return keys ^ (keys >> numpy.uint64(31))
+
+
+def row_ranks(matrix, keys):
+    """position of every entry of the csr matrix in its row when the row is sorted by keys"""
+    rows = numpy.repeat(numpy.arange(matrix.shape[0]), numpy.diff(matrix.indptr))
+    order = numpy.lexsort((keys, rows))
+    rank = numpy.empty(matrix.nnz, dtype=numpy.int64)
+    rank[order] = numpy.arange(matrix.nnz) - matrix.indptr[rows[order]]
+    return rank
+
+
+def sample_entries(matrix, limit, keys):
+    """copy of the csr matrix keeping the limit entries with the smallest keys in every row"""
+    counts = numpy.diff(matrix.indptr)
+    if limit is None or counts.max(initial=0) <= limit:
+        return matrix
+    keep = row_ranks(matrix, keys) < limit
+    indptr = numpy.concatenate([[0], numpy.cumsum(numpy.minimum(counts, limit))])
+    return sparse.csr_matrix((matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
+
+
+def cap_watched_matrix(watched_matrix, max_items_per_user=None, max_users_per_movie=None, user_rows=None, seed=0):
+    """the watched matrix the cooccurrence is counted on, with heavy users and popular movies sampled
+
+    a user who watched more than max_items_per_user movies keeps a sample of them, so
+    no user adds more than max_items_per_user ** 2 counts; a movie watched by more than
+    max_users_per_movie users keeps a sample of them, which scales its cooccurrences down
+    by about max_users_per_movie / watchers. The samples only depend on the (user, movie)
+    pairs, user_rows are the users of the rows of watched_matrix, by default 0, 1, ...
+    """
+    if user_rows is None:
+        user_rows = numpy.arange(watched_matrix.shape[0])
+    rows = numpy.repeat(user_rows, numpy.diff(watched_matrix.indptr))
+    matrix = sample_entries(watched_matrix, max_items_per_user, entry_keys(rows, watched_matrix.indices, seed))
+    if max_users_per_movie is not None:
+        matrix = matrix.tocsc()  # same entries by movie, matrix.indices are the user positions
+        keys = entry_keys(user_rows[matrix.indices], numpy.repeat(numpy.arange(matrix.shape[1]),
+                                                                  numpy.diff(matrix.indptr)), seed)
+        by_movie = sparse.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=matrix.shape[::-1])
+        matrix = sample_entries(by_movie, max_users_per_movie, keys).T.tocsr()
+    return matrix
+
+
+def cooccurrence_work(watched_matrix):
+    """number of pair updates A.T * A makes, every user adds the square of their movies"""
+    counts = numpy.diff(watched_matrix.indptr).astype(numpy.int64)
+    return int((counts * counts).sum())
+
+
+class BlockedMatrix(object):
+    """a square matrix kept on disk as column blocks, see cooccurrence_blocks
+
+    block k is a csr_matrix of every row and the columns start..stop of blocks[k],
+    memory-mapped from its own save_columns file when read, so only the block in use
+    has to fit in memory; the counts are saved as counts_dtype where they fit, see narrow_counts
+    """
+
+    def __init__(self, shape, directory, movie_block, blocks, counts_dtype=numpy.int64):
+        self.shape = shape
+        self.directory = directory # the block files are in this directory
+        self.movie_block = movie_block # columns of every block
+        self.blocks = blocks # [(start, stop, path, nnz)]
+        self.counts_dtype = counts_dtype # dtype of the saved counts by the storage mode
+
+    @property
+    def nnz(self):
+        return sum(block[3] for block in self.blocks)
+
+    def block(self, k):
+        start, stop, path, _ = self.blocks[k]
+        _, columns = load_columns(path)
+        return sparse.csr_matrix((columns["data"], columns["indices"], columns["indptr"]),
+                                 shape=(self.shape[0], stop - start), copy=False)
+
+    def save_block(self, k, block):
+        """replace block k, the file is swapped in whole so mapped readers keep the old one"""
+        start, stop, path, _ = self.blocks[k]
+        try:
+            save_columns(path + ".tmp", indptr=block.indptr.astype(numpy.int64),
+                         indices=block.indices.astype(numpy.int32),
+                         data=narrow_counts(block.data.astype(numpy.int64), self.counts_dtype))
+        except BaseException:
+            remove_file(path + ".tmp")
+            raise
+        os.replace(path + ".tmp", path)
+        self.blocks[k] = (start, stop, path, int(block.nnz))
+
+    def remove(self):
+        """delete the block files, the matrix can not be read after this"""
+        for _, _, path, _ in self.blocks:
+            remove_file(path)
+
+    def left_dot(self, matrix):
+        """dense matrix x self for a sparse matrix of a few rows, one column block at a time"""
+        return numpy.hstack([matrix.dot(self.block(k)).toarray() for k in range(len(self.blocks))])
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def cooccurrence_blocks(watched_matrix, directory, movie_block=4096, counts_dtype=numpy.int64):
+    """cooccurrence_matrix computed movie_block columns at a time and spilled to directory
+
+    column block start..stop is A.T * A[:, start:stop], only one block is in memory at
+    once, returns the BlockedMatrix over the block files. The block files of an earlier
+    run in directory are removed first, whatever their movie_block was
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if re.fullmatch(r"cooccurrence-\d+-\d+\.mrsnap(\.tmp)?", name):
+            remove_file(os.path.join(directory, name))
+    movies_count = watched_matrix.shape[1]
+    watched_t = watched_matrix.T.tocsr()
+    watched_csc = watched_matrix.tocsc()
+    matrix = BlockedMatrix((movies_count, movies_count), directory, movie_block, [], counts_dtype)
+    for start in range(0, movies_count, movie_block):
+        stop = min(start + movie_block, movies_count)
+        matrix.blocks.append((start, stop, os.path.join(directory, "cooccurrence-%d-%d.mrsnap" % (start, stop)), 0))
+        matrix.save_block(len(matrix.blocks) - 1, (watched_t * watched_csc[:, start:stop]).tocsr())
+    return matrix
+
+
+def normalize_rows(rating_matrix):
+    """(rating_matrix with every row scaled to length 1, the row norms), empty rows stay empty"""
+    norms = numpy.sqrt(numpy.asarray(rating_matrix.multiply(rating_matrix).sum(axis=1)).ravel())
+    scale = numpy.zeros(len(norms), dtype=rating_matrix.dtype)
+    scale[norms > 0] = 1 / norms[norms > 0]
+    return sparse.diags(scale).dot(rating_matrix).tocsr(), norms
+
+
+def similarity_block(normalized, normalized_t, norms, block_rows):
+    """dense cosine similarity of the rows at block_rows with every row, see normalize_rows"""
+    block = normalized[block_rows].dot(normalized_t).toarray()
+    # a row with ratings has similarity 1 with itself
+    block[numpy.arange(len(block_rows)), block_rows] = norms[block_rows] > 0
+    return block
+
+
+def top_k_neighbors(block, block_rows, top_k):
+    """(rows, columns, similarities) of the top_k most similar other rows in a similarity block"""
+    top_k = min(top_k, block.shape[1] - 1)
+    if top_k <= 0:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+    block[numpy.arange(len(block_rows)), block_rows] = 0
+    cols = numpy.argpartition(-block, top_k - 1, axis=1)[:, :top_k]
+    values = numpy.take_along_axis(block, cols, axis=1)
+    keep = values > 0
+    return numpy.repeat(block_rows, top_k)[keep.ravel()], cols[keep], values[keep]
+
+
+def keep_top_k(rows, cols, values, top_k, shape):
+    """csr_matrix of the (rows, cols, values) entries keeping only the top_k largest of every row"""
+    order = numpy.lexsort((-values, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    row_starts = numpy.searchsorted(rows, rows)
+    keep = numpy.arange(len(rows)) - row_starts < top_k
+    return sparse.csr_matrix((values[keep], (rows[keep], cols[keep])), shape=shape)
+
+
+def cosine_similarity_matrix(rating_matrix, top_k=None, block_size=1024):
+    """cosine similarity between every two rows of the sparse rating_matrix
+
+    rows are normalized once and multiplied block_size rows at a time, a row without
+    ratings is similar to no row. Returns a dense ndarray, or with top_k a csr_matrix
+    keeping only the k most similar other rows of every row, so memory is O(rows * k)
+    """
+    rows_count = rating_matrix.shape[0]
+    normalized, norms = normalize_rows(rating_matrix)
+    normalized_t = normalized.T.tocsr()
+
+    if top_k is None:
+        similar_matrix = numpy.zeros((rows_count, rows_count), dtype=normalized.dtype)
+    neighbors = []  # [(row indices, column indices, similarities)] of every block
+    for start in range(0, rows_count, block_size):
+        block_rows = numpy.arange(start, min(start + block_size, rows_count))
+        block = similarity_block(normalized, normalized_t, norms, block_rows)
+        if top_k is None:
+            similar_matrix[block_rows] = block
+        else:
+            neighbors.append(top_k_neighbors(block, block_rows, top_k))
+
+    if top_k is None:
+        return similar_matrix
+    if not neighbors:
+        return sparse.csr_matrix((rows_count, rows_count))
+    rows, cols, values = (numpy.concatenate(part) for part in zip(*neighbors))
+    return sparse.csr_matrix((values, (rows, cols)), shape=(rows_count, rows_count))
+
+
+def lsh_similarity_matrix(rating_matrix, top_k, tables=8, bits=8, seed=0, block_size=1024):
+    """approximate top_k cosine similarity of the rows of rating_matrix with random-projection LSH
+
+    every table hashes a row to the signs of bits random projections and compares rows
+    only with the rows in the same bucket, so a table costs about 1 / 2**bits of the
+    exact scan. More tables find more of the true neighbors, more bits make the buckets
+    smaller and the lookup faster; pairs of similarity s share a bucket with probability
+    (1 - acos(s) / pi) ** bits per table. Returns a csr_matrix like cosine_similarity_matrix
+    with top_k, the similarities kept are exact
+    """
+    rows_count, columns_count = rating_matrix.shape
+    normalized, norms = normalize_rows(rating_matrix)
+    rated = numpy.flatnonzero(norms > 0)
+    random = numpy.random.default_rng(seed)
+    neighbors = []  # [(row indices, column indices, similarities)] of every bucket block
+    for _ in range(tables):
+        projections = random.standard_normal((columns_count, bits))
+        codes = numpy.zeros(len(rated), dtype=numpy.int64)
+        for start in range(0, len(rated), block_size):
+            signs = normalized[rated[start:start + block_size]].dot(projections) > 0
+            codes[start:start + block_size] = signs.dot(numpy.int64(1) << numpy.arange(bits, dtype=numpy.int64))
+
+        # step1: exact similarity inside every bucket, block_size rows at a time
+        order = numpy.argsort(codes, kind="stable")
+        bucket_starts = numpy.flatnonzero(numpy.diff(codes[order], prepend=-1))
+        for bucket in numpy.split(rated[order], bucket_starts[1:]):
+            if len(bucket) < 2:
+                continue
+            bucket_t = normalized[bucket].T.tocsr()
+            for start in range(0, len(bucket), block_size):
+                block_rows = numpy.arange(start, min(start + block_size, len(bucket)))
+                block = normalized[bucket[block_rows]].dot(bucket_t).toarray()
+                rows, cols, values = top_k_neighbors(block, block_rows, top_k)
+                neighbors.append((bucket[rows], bucket[cols], values))
+    if not neighbors:
+        return sparse.csr_matrix((rows_count, rows_count))
+
+    # step2: a pair found by several tables is kept once, then the top_k of every row
+    rows, cols, values = (numpy.concatenate(part) for part in zip(*neighbors))
+    _, first = numpy.unique(rows * rows_count + cols, return_index=True)
+    return keep_top_k(rows[first], cols[first], values[first], top_k, (rows_count, rows_count))
+
+
+def neighbor_recall(similar_matrix, exact_rows, exact_block, top_k):
+    """mean share of the exact top_k neighbors that similar_matrix found for the rows exact_rows
+
+    exact_block is the exact similarity of exact_rows with every row, see similarity_block.
+    A found neighbor as similar as the k-th exact one counts, so ties do not matter
+    """
+    neighbor_rows, _, exact_values = top_k_neighbors(exact_block, exact_rows, top_k)
+    recalls = []
+    for row in numpy.unique(neighbor_rows):
+        exact = exact_values[neighbor_rows == row]
+        found = similar_matrix[row].data
+        recalls.append(min(numpy.count_nonzero(found >= exact.min() - 1e-12), len(exact)) / len(exact))
+    return numpy.mean(recalls) if recalls else 1.0
+
+
+def als_batches(counts, max_entries=1 << 12):
+    """[rows] of the rows to solve together, a batch pads every row to its longest one
+
+    rows are taken in order of their count so a batch holds rows of about the same
+    length, and a batch grows until rows * longest row would pass max_entries
+    """
+    order = numpy.argsort(counts, kind="stable")
+    widths = numpy.maximum(counts[order], 1)
+    batches, start = [], 0
+    while start < len(order):
+        # a batch of n rows is as wide as its last row, the widths only grow
+        sizes = numpy.arange(1, min(max_entries, len(order) - start) + 1)
+        fits = sizes * widths[start:start + len(sizes)] <= max_entries
+        stop = start + max(int(numpy.count_nonzero(fits)), 1)
+        batches.append(order[start:stop])
+        start = stop
+    return batches
+
+
+def solve_als_rows(confidence_matrix, rows, fixed, gram, regularization):
+    """factors of the rows of confidence_matrix against the fixed factors of its columns
+
+    solves (F.T F + F.T (C_u - I) F + regularization I) x_u = F.T C_u p_u for every row u
+    at once, with p_u 1 for every rated column and C_u its confidence, F.T F is gram.
+    The rated columns of every row are padded into one (rows, longest, k) array so the
+    products and solves are batched matrix operations
+    """
+    k = fixed.shape[1]
+    indptr = confidence_matrix.indptr
+    counts = indptr[rows + 1] - indptr[rows]
+    width = max(int(counts.max()) if len(rows) else 0, 1)
+    # column j of a padded row is the j-th rated movie of the row, padding weighs 0
+    offsets = numpy.arange(width)
+    present = offsets < counts[:, None]
+    positions = numpy.where(present, indptr[rows][:, None] + offsets, 0)
+    confidence = numpy.where(present, confidence_matrix.data[positions], 0.0)
+    padded = fixed[confidence_matrix.indices[positions]]
+    weighted = padded * numpy.where(present, confidence - 1.0, 0.0)[:, :, None]
+    lhs = gram + numpy.matmul(weighted.transpose(0, 2, 1), padded) + regularization * numpy.eye(k)
+    rhs = numpy.matmul(confidence[:, None, :], padded)
+    return numpy.linalg.solve(lhs, rhs.transpose(0, 2, 1))[:, :, 0]
+
+
+def solve_als_side(confidence_matrix, fixed, regularization, rows=None, threads=None, max_entries=1 << 12):
+    """new factors of the rows of confidence_matrix with the column factors fixed
+
+    only the given rows are solved if rows is set, the batches run on threads threads,
+    numpy releases the GIL in its matrix products and solves
+    """
+    if rows is None:
+        rows = numpy.arange(confidence_matrix.shape[0])
+    gram = fixed.T.dot(fixed)
+    counts = numpy.diff(confidence_matrix.indptr)[rows]
+    batches = als_batches(counts, max_entries)
+    factors = numpy.zeros((len(rows), fixed.shape[1]))
+
+    def solve(batch):
+        return batch, solve_als_rows(confidence_matrix, rows[batch], fixed, gram, regularization)
+
+    if threads and threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            solved = list(executor.map(solve, batches))
+    else:
+        solved = [solve(batch) for batch in batches]
+    for batch, batch_factors in solved:
+        factors[batch] = batch_factors
+    return factors
+
+
+def als_factors(confidence_matrix, factors=32, regularization=10.0, iterations=10, seed=0, threads=None):
+    """(user factors, movie factors) of an implicit feedback ALS factorization
+
+    confidence_matrix is users x movies with the confidence of every watched movie, the
+    preference is 1 for a watched movie and 0 for the rest. User and movie factors are
+    solved in turn with the other side fixed, see solve_als_side; the model is the
+    (users + movies) x factors matrices and a user's scores are one product with the
+    movie factors
+    """
+    random = numpy.random.default_rng(seed)
+    users_count, movies_count = confidence_matrix.shape
+    confidence_matrix = confidence_matrix.tocsr()
+    confidence_matrix_t = confidence_matrix.T.tocsr()
+    user_factors = numpy.zeros((users_count, factors))
+    movie_factors = random.normal(0.0, 0.01, (movies_count, factors))
+    for _ in range(iterations):
+        user_factors = solve_als_side(confidence_matrix, movie_factors, regularization, threads=threads)
+        movie_factors = solve_als_side(confidence_matrix_t, user_factors, regularization, threads=threads)
+    return user_factors, movie_factors
+
+
+def mask_watched(scores, watched_matrix):
+    """copy of the dense users x movies scores with the watched movies set to -inf, float32 scores stay float32"""
+    scores = numpy.array(scores, dtype=numpy.result_type(scores.dtype, numpy.float32))
+    watched_rows = numpy.repeat(numpy.arange(watched_matrix.shape[0]), numpy.diff(watched_matrix.indptr))
+    scores[watched_rows, watched_matrix.indices] = -numpy.inf
+    return scores
+
+
+def best_movie_indices(scores, watched_matrix):
+    """for every row of scores, the sorted indices of the unwatched movies with the highest score
+
+    scores is a dense users x movies block, watched_matrix the matching csr rows; all
+    movies tied at the highest score are returned, nothing if every movie was watched
+    """
+    scores = mask_watched(scores, watched_matrix)
+    max_scores = scores.max(axis=1, initial=-numpy.inf)
+    best = (scores == max_scores[:, None]) & numpy.isfinite(max_scores)[:, None]
+    return [numpy.flatnonzero(row) for row in best]
+
+
+def top_movie_indices(scores, watched_matrix, top_n):
+    """for every row of scores, the indices of the top_n unwatched movies, best first
+
+    only top_n candidates per row are partitioned out and sorted, so asking for 50
+    movies costs about the same as asking for one; equal scores keep index order
+    """
+    scores = mask_watched(scores, watched_matrix)
+    if min(top_n, scores.shape[1]) <= 0:
+        return [numpy.zeros(0, dtype=numpy.intp) for _ in range(scores.shape[0])]
+    candidates, candidate_scores = top_candidates(scores, top_n)
+    return [row[numpy.isfinite(row_scores)] for row, row_scores in zip(candidates, candidate_scores)]
+
+
+def top_candidates(scores, top_n):
+    """(indices, scores) of the top_n highest scores of every row, best first
+
+    of the scores tied at the cut the smallest indices are taken, so the pick does not
+    depend on how the row was partitioned
+    """
+    top_n = min(top_n, scores.shape[1])
+    threshold = -numpy.partition(-scores, top_n - 1, axis=1)[:, top_n - 1:top_n]
+    above = scores > threshold
+    tied = scores == threshold
+    room = top_n - above.sum(axis=1, keepdims=True)
+    keep = above | (tied & (numpy.cumsum(tied, axis=1) <= room))
+    candidates = numpy.nonzero(keep)[1].reshape(scores.shape[0], top_n)
+    candidate_scores = numpy.take_along_axis(scores, candidates, axis=1)
+    order = numpy.lexsort((candidates, -candidate_scores), axis=1)
+    return numpy.take_along_axis(candidates, order, axis=1), numpy.take_along_axis(candidate_scores, order, axis=1)
+
+
+def holdout_split(ratings_table, fraction=0.2, seed=0):
+    """(train, test) csr tables splitting the ratings of every user, test holds about fraction of them
+
+    a user keeps at least one rating in train, which ratings are held out only depends
+    on the (user, movie) pairs and seed, see entry_keys
+    """
+    table = ratings_table.tocsr()
+    counts = numpy.diff(table.indptr)
+    rows = numpy.repeat(numpy.arange(table.shape[0]), counts)
+    held = numpy.minimum(numpy.floor(counts * fraction + 0.5).astype(numpy.int64), counts - 1)
+    test = row_ranks(table, entry_keys(rows, table.indices, seed)) < held[rows]
+    train, test = (sparse.csr_matrix((table.data[part], (rows[part], table.indices[part])), shape=table.shape)
+                   for part in (~test, test))
+    return train, test
+
+
+def ranking_metrics(selected, test_table, k):
+    """{'users', 'precision', 'recall', 'coverage'} of the movie indices selected for every user
+
+    precision@k is the share of a user's k picks that were held out, recall@k the share
+    of the held out movies among the picks, both averaged over the users with held out
+    ratings; coverage is the share of all movies picked for anyone
+    """
+    users_count, movies_count = test_table.shape
+    lengths = numpy.array([len(movie_indices) for movie_indices in selected], dtype=numpy.int64)
+    rows = numpy.repeat(numpy.arange(users_count), lengths)
+    cols = numpy.concatenate([numpy.asarray(movie_indices, dtype=numpy.int64) for movie_indices in selected]
+                             + [numpy.zeros(0, dtype=numpy.int64)])
+    # a pick is a hit if its (user, movie) key is one of the sorted held out keys
+    test_keys = numpy.sort(numpy.repeat(numpy.arange(users_count), numpy.diff(test_table.indptr)) * movies_count
+                           + test_table.indices)
+    keys = rows * movies_count + cols
+    found = numpy.searchsorted(test_keys, keys)
+    hit = found < len(test_keys)
+    hit[hit] = test_keys[found[hit]] == keys[hit]
+    hits = numpy.bincount(rows[hit], minlength=users_count)
+    relevant = numpy.diff(test_table.indptr)
+    evaluated = relevant > 0
+    return {"users": int(evaluated.sum()),
+            "precision": float((hits[evaluated] / k).mean()) if evaluated.any() else 0.0,
+            "recall": float((hits[evaluated] / relevant[evaluated]).mean()) if evaluated.any() else 0.0,
+            "coverage": len(numpy.unique(cols)) / max(movies_count, 1)}
+
+
+class RecommendationWriter(object):
+    """stream recommendations to a file in chunks of about chunk_size bytes
+
+    write takes the recommendations of a block of users as soon as they are scored,
+    formatted records are buffered and written with one call per chunk, so nothing is
+    held for every user at once. Subclasses format the records, see open_writer
+    """
+
+    def __init__(self, path, chunk_size=1 << 20):
+        self.file = open(path, "wb")
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+        self.algorithms = [] # ['algorithm'] in order of appearance
+
+    def write(self, algorithm, user_ids, recommendations):
+        if algorithm not in self.algorithms:
+            self.algorithms.append(algorithm)
+        chunk = self.format(algorithm, user_ids, recommendations)
+        self.buffer.append(chunk)
+        self.buffered += len(chunk)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def format(self, algorithm, user_ids, recommendations):
+        raise NotImplementedError
+
+    def flush(self):
+        self.file.write(b"".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class CsvWriter(RecommendationWriter):
+    """one "algorithm,user_id,rank,movie_id" line per recommended movie, rank 1 is the best"""
+
+    def __init__(self, path, chunk_size=1 << 20):
+        RecommendationWriter.__init__(self, path, chunk_size)
+        self.buffer.append(b"algorithm,user_id,rank,movie_id\n")
+
+    def format(self, algorithm, user_ids, recommendations):
+        return "".join("%s,%s,%d,%s\n" % (algorithm, user_id, rank, movie_id)
+                       for user_id, movie_ids in zip(user_ids, recommendations)
+                       for rank, movie_id in enumerate(movie_ids, 1)).encode()
+
+
+class JsonLinesWriter(RecommendationWriter):
+    """one {"algorithm", "user_id", "movie_ids"} json line per user"""
+
+    def format(self, algorithm, user_ids, recommendations):
+        return "".join('{"algorithm": "%s", "user_id": %s, "movie_ids": %s}\n' % (algorithm, user_id, movie_ids)
+                       for user_id, movie_ids in zip(user_ids, recommendations)).encode()
+
+
+class BinaryWriter(RecommendationWriter):
+    """int64 records (algorithm number, user_id, count, count movie ids) after RECOMMENDATIONS_MAGIC
+
+    the algorithm numbers index the json list of algorithms written at the end of the file,
+    after the records and followed by its length as <Q
+    """
+
+    def __init__(self, path, chunk_size=1 << 20):
+        RecommendationWriter.__init__(self, path, chunk_size)
+        self.buffer.append(RECOMMENDATIONS_MAGIC)
+
+    def format(self, algorithm, user_ids, recommendations):
+        counts = numpy.array([len(movie_ids) for movie_ids in recommendations], dtype=numpy.int64)
+        if not len(counts):
+            return b""
+        records = numpy.zeros(3 * len(counts) + counts.sum(), dtype=numpy.int64)
+        starts = numpy.arange(len(counts)) * 3 + numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+        records[starts] = self.algorithms.index(algorithm)
+        records[starts + 1] = user_ids
+        records[starts + 2] = counts
+        is_movie = numpy.ones(len(records), dtype=bool)
+        is_movie[numpy.concatenate([starts, starts + 1, starts + 2])] = False
+        records[is_movie] = [movie_id for movie_ids in recommendations for movie_id in movie_ids]
+        return records.astype("<i8").tobytes()
+
+    def close(self):
+        algorithms = json.dumps(self.algorithms).encode()
+        self.buffer.append(algorithms + struct.pack("<Q", len(algorithms)))
+        RecommendationWriter.close(self)
+
+
+OUTPUT_WRITERS = {"csv": CsvWriter, "jsonl": JsonLinesWriter, "binary": BinaryWriter}
+OUTPUT_EXTENSIONS = {"": "csv", ".csv": "csv", ".jsonl": "jsonl", ".bin": "binary", ".binary": "binary"}
+
+
+def output_format_of(path):
+    """the output format of path's extension, csv for none; an unknown extension is a ValueError"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in OUTPUT_EXTENSIONS:
+        raise ValueError("unknown output extension '%s', choose one of %s or set the output format"
+                         % (extension, ", ".join(sorted(ext for ext in OUTPUT_EXTENSIONS if ext))))
+    return OUTPUT_EXTENSIONS[extension]
+
+
+def open_writer(path, output_format=None, chunk_size=1 << 20):
+    """RecommendationWriter for path, the format defaults to the file extension, see output_format_of"""
+    if output_format is None:
+        output_format = output_format_of(path)
+    return OUTPUT_WRITERS[output_format](path, chunk_size)
+
+
 class User(object):
+    """a user row of the program's ratings table, the ratings are not copied into the object"""
+    __slots__ = ('id', 'index', 'program', 'recommend_movie_ids')
 
-    def __init__(self, id):
+    def __init__(self, id, index=None, program=None):
         self.id = id
-        self.ratings = dict() # {movie_id : rating}
+        self.index = index # row of the user in the program's matrices
+        self.program = program # <MovieRecommendationProgram> holding the ratings
         self.recommend_movie_ids = dict() # {'algorithm' : [recommend_movie_id]}
         self.recommend_movie_ids['cooccurrence'] = list()
         self.recommend_movie_ids['user_based_cos_similarity'] = list()
+        self.recommend_movie_ids['item_based_cos_similarity'] = list()
+        self.recommend_movie_ids['als'] = list()
 
-    def watch_movie(self, movie_id, rating):
-        self.ratings[movie_id] = rating
+    @property
+    def ratings(self):
+        """{movie_id : rating}, built from the ratings table on every access"""
+        table = self.program.ratings_table
+        start, stop = table.indptr[self.index], table.indptr[self.index + 1]
+        movies_list = self.program.movies_list
+        return {movies_list[m_j]: rating
+                for m_j, rating in zip(table.indices[start:stop].tolist(),
+                                       decode_ratings(table.data[start:stop]).tolist())}
 
 
 class Movie(object):
+    """a movie column of the program's ratings table, the ratings are not copied into the object"""
+    __slots__ = ('id', 'index', 'program')
 
-    def __init__(self, id):
+    def __init__(self, id, index=None, program=None):
         self.id = id
-        self.ratings = dict() # {user_id: rating}
+        self.index = index # column of the movie in the program's matrices
+        self.program = program # <MovieRecommendationProgram> holding the ratings
 
-    def watched_by_user(self, user_id, rating):
-        self.ratings[user_id] = rating
+    @property
+    def ratings(self):
+        """{user_id: rating}, built from the ratings table on every access"""
+        table = self.program.ratings_by_movie()
+        start, stop = table.indptr[self.index], table.indptr[self.index + 1]
+        users_list = self.program.users_list
+        return {users_list[u_i]: rating
+                for u_i, rating in zip(table.indices[start:stop].tolist(),
+                                       decode_ratings(table.data[start:stop]).tolist())}
 
 
 class MovieRecommendationProgram(object):
@@ -40,19 +1269,233 @@ class MovieRecommendationProgram(object):
     movies = dict() # {movie_id : <Movie Object>}
     users_list = None # [user_id] used for mapping matrix index and user_id
     movies_list = None # [movie_id] used for mapping matrix index and movie_id
+    user_index = None # {user_id : matrix index}, inverse of users_list
+    movie_index = None # {movie_id : matrix index}, inverse of movies_list
+    ratings_table = None # <csr_matrix> users x movies, every rating including the 0.0 ones
+    output_writer = None # <RecommendationWriter> recommendations are streamed to instead of kept on the users
+    ratings_table_csc = None # <csc_matrix> the same ratings by movie, built on first use by ratings_by_movie
+    rating_matrix = None # <csr_matrix> users x movies, only non-zero ratings are stored
+    rating_matrix_csc = None # <csc_matrix> same ratings, for per-movie column access
+    watched_matrix = None # <csr_matrix> users x movies, 1 for every (user, movie) rated
+    cooccurrence_matrix = None # <ndarray or csr_matrix> movies x movies
+    cooccurrence_caps = None # {'max_items_per_user', 'max_users_per_movie'} the cooccurrence was counted with
+    similar_matrix = None # <ndarray or csr_matrix> users x users cosine similarity
+    item_neighbors = None # <csr_matrix> movies x movies, row j holds the top_k movies most similar to j
+    similar_top_k = None # top_k the similar matrix was pruned to, None if it is dense
+    user_norms = None # <ndarray> length of every user's rating vector
+    user_factors = None # <ndarray> users x factors of the ALS factorization
+    movie_factors = None # <ndarray> movies x factors of the ALS factorization
+    als_options = None # {'regularization', 'alpha', 'threads'} the ALS factors were solved with
+    matrix_cache = None # <MatrixCache> built matrices are read from and saved to
+    storage = 'float64' # name of the STORAGE_MODES entry the matrices are stored with
+    dtypes = STORAGE_MODES['float64'] # {'ratings_table', 'ratings', 'watched', 'counts', 'indices'} dtypes
+    rounded_ratings = 0 # ratings the uint8 ratings table could not keep exactly
+    ratings_key = None # sha256 hex of the ratings table, see ratings_digest
+    recommend_options = None # {'algorithm' : top_n} of every algorithm already run
+    score_methods = {'cooccurrence': 'cooccurrence_scores',
+                     'user_based_cos_similarity': 'user_based_scores',
+                     'item_based_cos_similarity': 'item_based_scores',
+                     'als': 'als_scores'} # {'algorithm' : scoring method}
+    shared_matrices = {'cooccurrence': ('watched_matrix', 'rating_matrix', 'cooccurrence_matrix'),
+                       'user_based_cos_similarity': ('watched_matrix', 'rating_matrix', 'rating_matrix_csc',
+                                                     'similar_matrix'),
+                       'item_based_cos_similarity': ('watched_matrix', 'rating_matrix', 'item_neighbors'),
+                       'als': ('watched_matrix', 'user_factors',
+                               'movie_factors')} # {'algorithm' : [matrix read by workers]}
 
-    def __init__(self):
+    def __init__(self, top_n=None, bulk_ingest=False, snapshot=None, save_snapshot_to=None, workers=None,
+                 item_based=False, item_neighbors_from=None, save_item_neighbors_to=None, item_top_k=50,
+                 similar_top_k=None, lsh_tables=None, lsh_bits=8, recall_report=False,
+                 serve_port=None, serve_host="127.0.0.1", cache_size=10000, max_batch_size=64, max_wait=0.002,
+                 max_request_bytes=1 << 24,
+                 report_to=None, profile_to=None, output_to=None, output_format=None,
+                 out_of_core_dir=None, movie_block=4096, max_items_per_user=None, max_users_per_movie=None,
+                 cap_report=False, als=False, als_factors=32, als_iterations=10, als_regularization=10.0,
+                 als_alpha=10.0, als_threads=None, matrix_cache_dir=None, matrix_cache_bytes=1 << 30,
+                 evaluate_k=None, holdout=0.2, storage='float64', storage_report=False, mongo_uri=None,
+                 mongo_database="test_database", mongo_collection="ratings",
+                 mongo_fields=("user_id", "movie_id", "rating"), mongo_batch_size=50000, mongo_partitions=1):
+        self.top_n = top_n # recommend the top_n movies of every user, None for the tied best ones
+        self.workers = workers # score users in this many processes, None to score them here
+        self.item_based = item_based # also run the item-based algorithm
+        self.item_neighbors_from = item_neighbors_from # read the item neighbor index from this file
+        self.save_item_neighbors_to = save_item_neighbors_to # write the item neighbor index to this file
+        self.item_top_k = item_top_k # keep only the item_top_k most similar movies of every movie
+        self.similar_top_k = similar_top_k # keep only the top_k similar users of every user
+        self.lsh_tables = lsh_tables # look the similar users up with this many LSH tables
+        self.lsh_bits = lsh_bits # bits of every LSH table
+        self.recall_report = recall_report # print the recall of the similar users against an exact scan
+        self.serve_port = serve_port # keep the model loaded and answer requests on this port
+        self.serve_host = serve_host # address the server listens on
+        self.cache_size = cache_size # recommendations the server keeps in its LRU cache
+        self.max_batch_size = max_batch_size # users the server scores together at most
+        self.max_wait = max_wait # seconds a server request waits for others to batch with
+        self.max_request_bytes = max_request_bytes # longest request line the server reads
+        self.bulk_ingest = bulk_ingest # read stdin with read_data_bulk instead of line by line
+        self.snapshot = snapshot # read the ratings from this snapshot file instead of stdin
+        self.save_snapshot_to = save_snapshot_to # write the parsed ratings to this snapshot file
+        self.report_to = report_to # write the json stage report to this file, "-" for stderr
+        self.profile_to = profile_to # write a cProfile dump of every stage to this directory
+        self.output_to = output_to # stream the recommendations to this file instead of printing them
+        self.output_format = output_format # csv, jsonl or binary, None for the output_to extension
+        self.out_of_core_dir = out_of_core_dir # spill the cooccurrence matrix to this directory in blocks
+        self.movie_block = movie_block # movies of every spilled cooccurrence block
+        self.max_items_per_user = max_items_per_user # count the cooccurrence on a sample of a heavy user's movies
+        self.max_users_per_movie = max_users_per_movie # count the cooccurrence on a sample of a popular movie's users
+        self.cap_report = cap_report # print the work the caps saved and how the recommendations changed
+        self.als = als # also recommend with an ALS matrix factorization
+        self.als_factors = als_factors # factors of every user and movie
+        self.als_iterations = als_iterations # rounds of solving the user and then the movie factors
+        self.als_regularization = als_regularization # weight of the factors' squared length in the loss
+        self.als_alpha = als_alpha # confidence of a watched movie is 1 + als_alpha * rating
+        self.als_threads = als_threads # solve the ALS batches on this many threads
+        self.evaluate_k = evaluate_k # only print precision@k, recall@k and coverage of every algorithm
+        self.holdout = holdout # share of every user's ratings held out when evaluating
+        self.storage = storage # store the ratings, counts and similarities with the dtypes of STORAGE_MODES[storage]
+        self.dtypes = STORAGE_MODES[storage]
+        self.storage_report = storage_report # print how the storage mode changed the recommendations
+        self.mongo_uri = mongo_uri # read the ratings from this MongoDB server instead of stdin
+        self.mongo_database = mongo_database
+        self.mongo_collection = mongo_collection
+        self.mongo_fields = mongo_fields # names of the user id, movie id and rating fields of the documents
+        self.mongo_batch_size = mongo_batch_size # documents of every raw batch a cursor gets
+        self.mongo_partitions = mongo_partitions # cursors reading user id ranges at once
+        if matrix_cache_dir:
+            self.matrix_cache = MatrixCache(matrix_cache_dir, matrix_cache_bytes)
+        self.cache_hits = dict() # {'algorithm' : True if its matrices were read from the matrix cache}
+        self.recommend_options = dict()
+        self.stages = [] # [{'stage', 'seconds', 'peak_rss_mb', ...}] of every stage run so far
         self.run()
 
     def run(self):
-        self.read_data()
-        self.do_cooccurrence_algorithm()
-        self.do_user_based_cos_similarity_algorithm()
-        self.show_result()
+        with self.stage("read") as info:
+            if self.snapshot:
+                self.read_snapshot(self.snapshot)
+            elif self.mongo_uri:
+                info.update(documents=self.read_mongo())
+            elif self.bulk_ingest:
+                self.read_data_bulk()
+            else:
+                self.read_data()
+            info.update(rows=int(self.ratings_table.nnz), users=len(self.users_list), movies=len(self.movies_list),
+                        rating_matrix=matrix_size(self.rating_matrix))
+        if self.save_snapshot_to:
+            with self.stage("save_snapshot") as info:
+                self.save_snapshot(self.save_snapshot_to)
+                info.update(bytes=os.path.getsize(self.save_snapshot_to))
+        if self.evaluate_k:
+            self.show_evaluation(self.evaluate(self.evaluate_k, self.holdout, workers=self.workers),
+                                 self.evaluate_k, self.holdout)
+            self.write_report()
+            return
+        # a server scores a user when asked, not every user up front
+        score_users = not self.serve_port
+        if self.output_to and score_users:
+            self.output_writer = open_writer(self.output_to, self.output_format)
+        scored_users = len(self.users_list) if score_users else 0
+        with self.stage("cooccurrence") as info:
+            self.do_cooccurrence_algorithm(top_n=self.top_n, workers=self.workers, score_users=score_users,
+                                           out_of_core_dir=self.out_of_core_dir, movie_block=self.movie_block,
+                                           max_items_per_user=self.max_items_per_user,
+                                           max_users_per_movie=self.max_users_per_movie)
+            info.update(rows=scored_users, cooccurrence_matrix=matrix_size(self.cooccurrence_matrix))
+            if self.max_items_per_user or self.max_users_per_movie:
+                info.update(work=cooccurrence_work(self.watched_matrix),
+                            capped_work=cooccurrence_work(cap_watched_matrix(self.watched_matrix,
+                                                                             **self.cooccurrence_caps)))
+        with self.stage("user_based_cos_similarity") as info:
+            self.do_user_based_cos_similarity_algorithm(top_k=self.similar_top_k, top_n=self.top_n,
+                                                        workers=self.workers, lsh_tables=self.lsh_tables,
+                                                        lsh_bits=self.lsh_bits, score_users=score_users)
+            info.update(rows=scored_users, similar_matrix=matrix_size(self.similar_matrix))
+        if self.item_based or self.item_neighbors_from or self.save_item_neighbors_to:
+            with self.stage("item_based_cos_similarity") as info:
+                if self.item_neighbors_from:
+                    self.read_item_neighbors(self.item_neighbors_from)
+                self.do_item_based_cos_similarity_algorithm(top_k=self.item_top_k, top_n=self.top_n,
+                                                            workers=self.workers, score_users=score_users)
+                if self.save_item_neighbors_to:
+                    self.save_item_neighbors(self.save_item_neighbors_to)
+                info.update(rows=scored_users, item_neighbors=matrix_size(self.item_neighbors))
+        if self.als:
+            with self.stage("als") as info:
+                self.do_als_algorithm(factors=self.als_factors, regularization=self.als_regularization,
+                                      iterations=self.als_iterations, alpha=self.als_alpha, threads=self.als_threads,
+                                      top_n=self.top_n, workers=self.workers, score_users=score_users)
+                info.update(rows=scored_users, user_factors=matrix_size(self.user_factors),
+                            movie_factors=matrix_size(self.movie_factors))
+        if self.serve_port:
+            self.write_report()
+            server = RecommendationServer(self, self.cache_size, self.max_batch_size, self.max_wait,
+                                          self.max_request_bytes)
+            server.serve(self.serve_host, self.serve_port)
+            self.remove_spilled_blocks()
+            return
+        if self.output_writer is not None:
+            with self.stage("write_output") as info:
+                self.output_writer.close()
+                self.output_writer = None
+                info.update(bytes=os.path.getsize(self.output_to))
+        else:
+            with self.stage("show_result") as info:
+                self.show_result()
+                info.update(rows=len(self.users_list))
+        if self.recall_report and self.similar_top_k:
+            self.show_similar_users_recall()
+        if self.cap_report and (self.max_items_per_user or self.max_users_per_movie):
+            self.show_cooccurrence_cap_report()
+        if self.storage_report:
+            self.show_storage_accuracy()
+        self.write_report()
+        self.remove_spilled_blocks()
+
+    def remove_spilled_blocks(self):
+        """delete the cooccurrence block files out_of_core_dir holds, once nothing reads them"""
+        if isinstance(self.cooccurrence_matrix, BlockedMatrix):
+            self.cooccurrence_matrix.remove()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """time the block as the stage name of the report, profile it too if profile_to is set
+
+        yields the stage's report entry, the block adds what it processed to it
+        """
+        info = {"stage": name}
+        profiler = None
+        if self.profile_to:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            info["seconds"] = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_to, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_to, "%02d-%s.prof" % (len(self.stages) + 1, name)))
+            info["peak_rss_mb"] = peak_rss_mb()
+            if name in self.cache_hits:
+                info["cache"] = "hit" if self.cache_hits[name] else "miss"
+            self.stages.append(info)
+
+    def write_report(self):
+        """write the stages run so far as json to report_to, if set"""
+        if not self.report_to:
+            return
+        report = {"stages": self.stages, "seconds": sum(info["seconds"] for info in self.stages),
+                  "peak_rss_mb": peak_rss_mb()}
+        if self.report_to == "-":
+            json.dump(report, sys.stderr, indent=2)
+            sys.stderr.write("\n")
+            return
+        with open(self.report_to, "w") as f:
+            json.dump(report, f, indent=2)
 
     def read_data(self):
-        users = self.users
-        movies = self.movies
+        user_ids = []
+        movie_ids = []
+        ratings = []
         for line in sys.stdin:
             orig_line = line
             matchObj = re.match("(.*?)#.*", line)  # using regex to remove comment
@@ -62,163 +1505,1267 @@ class MovieRecommendationProgram(object):
             if not self.is_valid(data):
                 error(" " * 8 + "The invalid data is: %s" % orig_line)
                 continue
-            user_id = int(data[0])
-            movie_id = int(data[1])
-            rating = float(data[2])
+            user_ids.append(int(data[0]))
+            movie_ids.append(int(data[1]))
+            ratings.append(float(data[2]))
+        self.load_ratings(user_ids, movie_ids, ratings)
+
+    def read_data_bulk(self, stream=None, chunk_size=1 << 22, max_reported=20):
+        """read ratings in blocks of about chunk_size bytes with vectorized parsing
+
+        lines are validated by the same rules as read_data, but the invalid ones are
+        reported together in one summary after reading, at most max_reported of them
+        """
+        if stream is None:
+            stream = getattr(sys.stdin, "buffer", sys.stdin)
+        columns = []  # [(user_ids, movie_ids, ratings)] of every block
+        invalid = []  # [(line number, message, line)]
+        lines_count = 0
+        rest = b""
+        while True:
+            block = stream.read(chunk_size)
+            if isinstance(block, str):
+                block = block.encode()
+            if not block:
+                data, rest = rest, b""
+            else:
+                cut = block.rfind(b"\n") + 1
+                if not cut:
+                    rest += block
+                    continue
+                data, rest = rest + block[:cut], block[cut:]
+            if data:
+                columns.append(self.parse_ratings(data, lines_count + 1, invalid))
+                lines_count += data.count(b"\n") + (not data.endswith(b"\n"))
+            if not block:
+                break
+        if columns:
+            user_ids, movie_ids, ratings = (numpy.concatenate(column) for column in zip(*columns))
+        else:
+            user_ids, movie_ids, ratings = [], [], []
+        if invalid:
+            error("Invalid data: %s of %s lines were skipped." % (len(invalid), lines_count))
+            for line_number, message, line in invalid[:max_reported]:
+                error(" " * 8 + "line %s: %s The invalid data is: %s" % (line_number, message, line.rstrip("\n")))
+            if len(invalid) > max_reported:
+                error(" " * 8 + "... and %s more invalid lines." % (len(invalid) - max_reported))
+        self.load_ratings(user_ids, movie_ids, ratings)
 
-            if user_id not in users:
-                users[user_id] = User(user_id)
-            if movie_id not in movies:
-                movies[movie_id] = Movie(movie_id)
-            users[user_id].watch_movie(movie_id, rating)
-            movies[movie_id].watched_by_user(user_id, rating)
-        self.users_list = list(users.keys())
-        self.movies_list = list(movies.keys())
+    def read_mongo(self, max_reported=20):
+        """read the ratings documents of the MongoDB collection with a MongoRatingsSource, return their count
+
+        invalid documents are reported together in one summary like read_data_bulk does
+        """
+        source = MongoRatingsSource(self.mongo_uri, self.mongo_database, self.mongo_collection, self.mongo_fields,
+                                    batch_size=self.mongo_batch_size, partitions=self.mongo_partitions)
+        try:
+            user_ids, movie_ids, ratings, invalid, documents_count = source.read()
+        finally:
+            source.client.close()
+        if invalid:
+            error("Invalid data: %s of %s documents were skipped." % (len(invalid), documents_count))
+            for number, message, fields in invalid[:max_reported]:
+                error(" " * 8 + "document %s: %s The invalid data is: %s" % (number, message, fields))
+            if len(invalid) > max_reported:
+                error(" " * 8 + "... and %s more invalid documents." % (len(invalid) - max_reported))
+        self.load_ratings(user_ids, movie_ids, ratings)
+        return documents_count
+
+    def parse_ratings(self, data, first_line_number, invalid):
+        """parse the bytes of complete lines into (user_ids, movie_ids, ratings) arrays
+
+        plain lines are converted by parse_rating_lines all at once, only the others
+        and the out of range ratings go through invalid_reason one by one;
+        (line number, message, line) of every invalid line is appended to invalid
+        """
+        parsed, user_ids, movie_ids, ratings = parse_rating_lines(data)
+        line_indices = numpy.flatnonzero(parsed)
+        in_range = (ratings >= 0) & (ratings <= 5)
+        recheck = numpy.union1d(numpy.flatnonzero(~parsed), line_indices[~in_range])
+        if not len(recheck):
+            return user_ids, movie_ids, ratings
+
+        # lines the fast path did not take may still be valid, e.g. with a "1e0" rating
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        line_ends = numpy.flatnonzero(numpy.frombuffer(data, dtype=numpy.uint8) == 10)
+        line_starts = numpy.concatenate([[0], line_ends[:-1] + 1])
+        extra = []
+        for i in recheck:
+            orig_line = data[line_starts[i]:line_ends[i]].decode(errors="replace")
+            matchObj = re.match("(.*?)#.*", orig_line)  # using regex to remove comment
+            line = matchObj.group(1) if matchObj else orig_line
+            line_data = [x.strip() for x in line.split(",")]  # split string with ","
+            message = self.invalid_reason(line_data)
+            if message:
+                invalid.append((first_line_number + i, message, orig_line))
+            else:
+                extra.append((i, int(line_data[0]), int(line_data[1]), float(line_data[2])))
+
+        # merge the late accepted lines back in input order
+        indices = [line_indices[in_range]] + [numpy.array([row[0] for row in extra], dtype=numpy.int64)]
+        order = numpy.argsort(numpy.concatenate(indices), kind="stable")
+        return tuple(numpy.concatenate([column[in_range], numpy.array([row[k] for row in extra], dtype=column.dtype)])[order]
+                     for k, column in enumerate((user_ids, movie_ids, ratings), 1))
+
+    def load_ratings(self, user_ids, movie_ids, ratings):
+        """load parsed rating columns in input order, a later rating of the same (user, movie) wins"""
+        user_ids = numpy.asarray(user_ids, dtype=numpy.int64)
+        movie_ids = numpy.asarray(movie_ids, dtype=numpy.int64)
+        ratings = numpy.asarray(ratings, dtype=numpy.float64)
+        users_list, user_rows = first_seen_order(user_ids)
+        movies_list, movie_cols = first_seen_order(movie_ids)
+
+        # keep only the last rating of every (user, movie) pair
+        keys = user_rows * len(movies_list) + movie_cols
+        _, last = numpy.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        ratings_table = sparse.csr_matrix((ratings[last], (user_rows[last], movie_cols[last])),
+                                          shape=(len(users_list), len(movies_list)), dtype=numpy.float64)
+        self.load_ratings_table(users_list, movies_list, ratings_table)
+
+    def load_ratings_table(self, users_list, movies_list, ratings_table):
+        """set up ids, users, movies and rating matrices from a users x movies csr table of every rating"""
+        self.users_list = list(users_list)
+        self.movies_list = list(movies_list)
+        self.user_index = {user_id: i for i, user_id in enumerate(self.users_list)}
+        self.movie_index = {movie_id: i for i, movie_id in enumerate(self.movies_list)}
+        self.ratings_table = self.stored_table(ratings_table)
+
+        # users and movies read their ratings from the table, nothing is stored per rating
+        self.users = {user_id: User(user_id, u_i, self) for u_i, user_id in enumerate(self.users_list)}
+        self.movies = {movie_id: Movie(movie_id, m_j, self) for m_j, movie_id in enumerate(self.movies_list)}
+        self.build_rating_matrices()
+
+    def stored_table(self, ratings_table):
+        """ratings_table with its ratings and indices in the dtypes of the storage mode"""
+        dtype, index_dtype = self.dtypes['ratings_table'], self.dtypes['indices']
+        if index_dtype is not None and ratings_table.nnz > numpy.iinfo(index_dtype).max:
+            index_dtype = None
+        if ratings_table.dtype == dtype and (index_dtype is None or ratings_table.indices.dtype == index_dtype):
+            return ratings_table
+        ratings = decode_ratings(ratings_table.data)
+        data = encode_ratings(ratings, dtype)
+        if ratings_table.dtype != numpy.uint8:
+            self.rounded_ratings = int(numpy.count_nonzero(decode_ratings(data) != ratings))
+        indices, indptr = ratings_table.indices, ratings_table.indptr
+        if index_dtype is not None:
+            indices, indptr = indices.astype(index_dtype), indptr.astype(index_dtype)
+        return sparse.csr_matrix((data, indices, indptr), shape=ratings_table.shape, copy=False)
+
+    def build_rating_matrices(self):
+        """build the sparse users x movies matrices, memory grows with the ratings count"""
+        ratings_table = self.ratings_table
+        self.ratings_table_csc = None
+        self.ratings_key = None
+        # a rating of 0.0 is still a watched movie, so keep presence apart from value
+        self.watched_matrix = sparse.csr_matrix(
+            (numpy.ones(ratings_table.nnz, dtype=self.dtypes['watched']), ratings_table.indices, ratings_table.indptr),
+            shape=ratings_table.shape)
+        self.rating_matrix = sparse.csr_matrix(
+            (decode_ratings(ratings_table.data, self.dtypes['ratings']), ratings_table.indices.copy(),
+             ratings_table.indptr.copy()), shape=ratings_table.shape)
+        self.rating_matrix.eliminate_zeros()
+        self.rating_matrix_csc = self.rating_matrix.tocsc()
+
+    def ratings_by_movie(self):
+        """the ratings table as csc_matrix, for reading the ratings of a movie"""
+        if self.ratings_table_csc is None:
+            self.ratings_table_csc = self.ratings_table.tocsc()
+        return self.ratings_table_csc
+
+    def ratings_digest(self):
+        """sha256 hex of the ratings table and id lists, the same however the ratings were read"""
+        if self.ratings_key is None:
+            table = self.ratings_table
+            digest = hashlib.sha256()
+            for column in (numpy.asarray(self.users_list, dtype=numpy.int64),
+                           numpy.asarray(self.movies_list, dtype=numpy.int64),
+                           numpy.asarray(table.indptr, dtype=numpy.int64),
+                           numpy.asarray(table.indices, dtype=numpy.int64),
+                           decode_ratings(table.data)):
+                digest.update(numpy.ascontiguousarray(column).tobytes())
+            self.ratings_key = digest.hexdigest()
+        return self.ratings_key
+
+    def cached_matrices(self, algorithm, parameters, build, names):
+        """{name: matrix} that build() returns, read from the matrix cache instead when the same
+        ratings were built with the same parameters before; a cache entry without every one of
+        names is built again
+        """
+        if self.matrix_cache is None:
+            return build()
+        key = self.matrix_cache.key(self.ratings_digest(), algorithm, dict(parameters, storage=self.storage))
+        matrices = self.matrix_cache.load(key, names)
+        self.cache_hits[algorithm] = matrices is not None
+        if matrices is None:
+            matrices = build()
+            self.matrix_cache.store(key, matrices)
+        return matrices
+
+    def save_snapshot(self, path):
+        """write the parsed ratings and id maps to a binary snapshot file, see read_snapshot"""
+        table = self.ratings_table
+        save_columns(path, shape=list(table.shape),
+                     users=numpy.asarray(self.users_list, dtype=numpy.int64),
+                     movies=numpy.asarray(self.movies_list, dtype=numpy.int64),
+                     indptr=table.indptr.astype(numpy.int64),
+                     indices=table.indices.astype(numpy.int32),
+                     ratings=table.data if table.dtype == numpy.uint8 else table.data.astype(numpy.float64),
+                     rating_steps=RATING_STEPS)
+
+    def read_snapshot(self, path):
+        """load the ratings written by save_snapshot, the columns are memory-mapped, not parsed"""
+        header, columns = load_columns(path)
+        if columns["ratings"].dtype == numpy.uint8 and header.get("rating_steps") != RATING_STEPS:
+            raise ValueError("%s keeps its ratings in steps of 1/%s, not 1/%d"
+                             % (path, header.get("rating_steps"), RATING_STEPS))
+        ratings_table = sparse.csr_matrix((columns["ratings"], columns["indices"], columns["indptr"]),
+                                          shape=tuple(header["shape"]), copy=False)
+        self.load_ratings_table(columns["users"].tolist(), columns["movies"].tolist(), ratings_table)
 
     def is_valid(self, data):
         """check whether the input data is valid"""
+        message = self.invalid_reason(data)
+        if message:
+            error(message)
+            return False
+        return True
+
+    def invalid_reason(self, data):
+        """the error message why the input data is invalid, None if it is valid"""
         # 1. check data length
         if len(data) != 3:
-            error("Invalid data: expect 3 splited values, got: %s." % len(data))
-            return False
+            return "Invalid data: expect 3 splited values, got: %s." % len(data)
         # 2. check user_id is integer
-        if not data[0].isdigit():
-            error("Invalid data: user_id '%s' is not an integer." % data[0])
-            return False
+        if not data[0].isdecimal():
+            return "Invalid data: user_id '%s' is not an integer." % data[0]
+        if int(data[0]) > MAX_ID:
+            return "Invalid data: user_id '%s' is out of range." % data[0]
         # 3. check movie_id is integer
-        if not data[1].isdigit():
-            error("Invalid data: user_id '%s' is not an integer." % data[1])
-            return False
+        if not data[1].isdecimal():
+            return "Invalid data: user_id '%s' is not an integer." % data[1]
+        if int(data[1]) > MAX_ID:
+            return "Invalid data: movie_id '%s' is out of range." % data[1]
         # 4. check rating is floating and in range[0.0, 5.0]
         try:
             rating = float(data[2])
+            if rating != rating:  # nan compares false with every bound
+                return "Invalid data: rating '%s' is not a number." % data[2]
             if rating < 0 or rating > 5:
-                error("Invalid data: rating '%s' is out of range." % data[2])
-                return False
+                return "Invalid data: rating '%s' is out of range." % data[2]
         except ValueError:
-            error("Invalid data: rating '%s' is not a floating." % data[2])
-            return False
-        return True
+            return "Invalid data: rating '%s' is not a floating." % data[2]
+        return None
 
-    def do_cooccurrence_algorithm(self):
-        """cooccurrence recommender algorithm"""
-        users = self.users
-        movies = self.movies
-        users_list = self.users_list
-        movies_list = self.movies_list
-        users_count = len(self.users)
-        movies_count = len(self.movies)
+    def do_cooccurrence_algorithm(self, sparse_output=False, top_n=None, block_size=1024, workers=None,
+                                  score_users=True, out_of_core_dir=None, movie_block=4096,
+                                  max_items_per_user=None, max_users_per_movie=None):
+        """cooccurrence recommender algorithm, keep the cooccurrence matrix sparse if sparse_output
 
+        recommend the top_n movies of every user, or all movies tied at the best weight,
+        with workers the blocks of users are scored in a process pool, without score_users
+        only the model is built and recommend_users scores users when asked.
+        With out_of_core_dir the matrix is spilled there in blocks of movie_block columns
+        and users are scored one block at a time, see recommend_out_of_core; workers are
+        not used then. max_items_per_user and max_users_per_movie cap the counting work of
+        heavy users and popular movies by sampling, see cap_watched_matrix
+        """
         # step1: calculate cooccurrence matrix
-        matrix = numpy.zeros((movies_count, movies_count))
-        for user_id in users_list:
-            seen = set()
-            for movie_id1 in users[user_id].ratings:
-                for movie_id2 in users[user_id].ratings:
-                    if movie_id2 in seen:
-                        continue
-                    m_i = movies_list.index(movie_id1)
-                    m_j = movies_list.index(movie_id2)
-                    if m_i == m_j:
-                        matrix[m_i][m_j] += 1
-                    else:
-                        matrix[m_i][m_j] += 1
-                        matrix[m_j][m_i] += 1
-                seen.add(movie_id1)
+        self.cooccurrence_caps = {'max_items_per_user': max_items_per_user,
+                                  'max_users_per_movie': max_users_per_movie}
+        if out_of_core_dir:
+            watched_matrix = cap_watched_matrix(self.watched_matrix, max_items_per_user, max_users_per_movie)
+            matrix = cooccurrence_blocks(watched_matrix, out_of_core_dir, movie_block, self.dtypes['counts'])
+        else:
+            def build():
+                watched_matrix = cap_watched_matrix(self.watched_matrix, max_items_per_user, max_users_per_movie)
+                return {'cooccurrence_matrix': cooccurrence_matrix(watched_matrix, sparse_output, self.dtypes['counts'])}
+            parameters = dict(self.cooccurrence_caps, sparse_output=sparse_output)
+            matrix = self.cached_matrices('cooccurrence', parameters, build,
+                                          ['cooccurrence_matrix'])['cooccurrence_matrix']
+        self.cooccurrence_matrix = matrix
+        self.recommend_options['cooccurrence'] = top_n
+        if not score_users:
+            return
 
         # step2: multiplying cooccurrence matrix with user's rating vector to produce a
         # weight vector that lead to recommendation, choose the weight user doesn't
-        # have and with highest values in the weight vector
-        for user_id, user in users.items():
-            user_ratings_list = [0] * movies_count
-            for movie_id, rating in user.ratings.items():
-                m_i = movies_list.index(movie_id)
-                user_ratings_list[m_i] = rating
-            weights = list(matrix.dot(user_ratings_list))
-            recommend_movie_ids = []
-            max_weight = 0
-            for i, weight in enumerate(weights):
-                if movies_list[i] in user.ratings:
-                    continue
-                if weight > max_weight:
-                    max_weight = weight
-                    recommend_movie_ids = [movies_list[i]]
-                elif weight == max_weight:
-                    recommend_movie_ids.append(movies_list[i])
-            user.recommend_movie_ids['cooccurrence'] = sorted(recommend_movie_ids)
-
-    def do_user_based_cos_similarity_algorithm(self):
-        """User based cos similarity recommendation algorithm"""
-        users = self.users
-        movies = self.movies
-        users_list = self.users_list
-        movies_list = self.movies_list
-        users_count = len(self.users)
-        movies_count = len(self.movies)
+        # have and with highest values in the weight vector, a block of users at once
+        if out_of_core_dir:
+            self.recommend_out_of_core(top_n, block_size)
+            return
+        self.recommend_all('cooccurrence', top_n, block_size, workers)
 
-        # step1: using cosine_similarity to calculate similar matrix
-        rating_matrix = numpy.zeros((users_count, movies_count))
-        for user_id in users_list:
-            for movie_id in users[user_id].ratings:
-                m_i = users_list.index(user_id)
-                m_j = movies_list.index(movie_id)
-                rating_matrix[m_i][m_j] = users[user_id].ratings[movie_id]
-
-        similar_matrix = numpy.zeros((users_count, users_count))
-        for i in range(users_count):
-            for j in range(i, users_count):
-                if sum(rating_matrix[i]) == 0.0 or sum(rating_matrix[j]) == 0.0:
-                    continue
-                elif i == j:
-                    similar_matrix[i][j] = 1
+    def cooccurrence_scores(self, user_rows):
+        """cooccurrence weight of every movie for the users at user_rows"""
+        # the cooccurrence matrix is symmetric, so ratings x matrix == (matrix x ratings).T
+        if isinstance(self.cooccurrence_matrix, BlockedMatrix):
+            return self.cooccurrence_matrix.left_dot(self.rating_matrix[user_rows])
+        weights = self.rating_matrix[user_rows].dot(self.cooccurrence_matrix)
+        if sparse.issparse(weights):
+            weights = weights.toarray()
+        return weights
+
+    def recommend_out_of_core(self, top_n=None, block_size=1024):
+        """score and store the cooccurrence recommendations with a BlockedMatrix model
+
+        a block of users is scored against one column block at a time and the picks of
+        every column block are merged, so block_size users x movie_block scores are in
+        memory at once, never a full row of scores. The picks equal the in-memory ones
+        """
+        matrix = self.cooccurrence_matrix
+        users_count = len(self.users_list)
+        for start in range(0, users_count, block_size):
+            user_rows = numpy.arange(start, min(start + block_size, users_count))
+            ratings = self.rating_matrix[user_rows]
+            watched = self.watched_matrix[user_rows].tocsc()
+            if top_n is None:
+                best_scores = numpy.full(len(user_rows), -numpy.inf)
+                best = [numpy.zeros(0, dtype=numpy.int64) for _ in user_rows]
+            else:
+                best_scores = numpy.full((len(user_rows), 0), -numpy.inf)
+                best = numpy.zeros((len(user_rows), 0), dtype=numpy.int64)
+            for k, (movie_start, movie_stop, _, _) in enumerate(matrix.blocks):
+                scores = mask_watched(ratings.dot(matrix.block(k)).toarray(), watched[:, movie_start:movie_stop].tocsr())
+                if top_n is None:
+                    # keep all movies tied at the best score seen so far
+                    block_max = scores.max(axis=1, initial=-numpy.inf)
+                    for i in numpy.flatnonzero(numpy.isfinite(block_max) & (block_max >= best_scores)):
+                        tied = numpy.flatnonzero(scores[i] == block_max[i]) + movie_start
+                        best[i] = tied if block_max[i] > best_scores[i] else numpy.concatenate([best[i], tied])
+                    best_scores = numpy.maximum(best_scores, block_max)
                 else:
-                    curr = 1 - spatial.distance.cosine(rating_matrix[i], rating_matrix[j])
-                    similar_matrix[i][j] = curr
-                    similar_matrix[j][i] = curr
-
-        # step2: naive and slow algorithm
-        for user_id in users_list:
-            recommend_movie_ids = []
-            max_avg_weight = -1
-            for movie_id in movies_list:
-                if movie_id in users[user_id].ratings:
-                    continue
-                weight = 0
-                count = 0
-                m_j = movies_list.index(movie_id)
-                for m_i in range(len(rating_matrix)):
-                    v = rating_matrix[m_i][m_j]
-                    if v == 0:
-                        continue
-                    weight += v * similar_matrix[users_list.index(user_id)][m_i]
-                    count += 1
-                avg_weight = weight / count if count != 0 else \
-                             0
-                if avg_weight > max_avg_weight:
-                    max_avg_weight = avg_weight
-                    recommend_movie_ids = [movie_id]
-                elif avg_weight == max_avg_weight:
-                    recommend_movie_ids.append(movie_id)
-            users[user_id].recommend_movie_ids['user_based_cos_similarity'] = sorted(recommend_movie_ids)
-
-    def show_result(self):
+                    # merge the block's top_n candidates into the top_n so far, ties by movie index
+                    candidates, candidate_scores = top_candidates(scores, top_n)
+                    candidate_scores = numpy.concatenate([best_scores, candidate_scores], axis=1)
+                    candidates = numpy.concatenate([best, candidates + movie_start], axis=1)
+                    order = numpy.lexsort((candidates, -candidate_scores), axis=1)[:, :top_n]
+                    best = numpy.take_along_axis(candidates, order, axis=1)
+                    best_scores = numpy.take_along_axis(candidate_scores, order, axis=1)
+            if top_n is not None:
+                best = [row[numpy.isfinite(row_scores)] for row, row_scores in zip(best, best_scores)]
+            self.save_recommendations('cooccurrence', user_rows, best, top_n)
+
+    def do_user_based_cos_similarity_algorithm(self, top_k=None, top_n=None, block_size=1024, workers=None,
+                                               lsh_tables=None, lsh_bits=8, score_users=True):
+        """User based cos similarity recommendation algorithm
+
+        with top_k only the k most similar users of every user are taken into account,
+        recommend the top_n movies of every user, or all movies tied at the best weight,
+        with workers the blocks of users are scored in a process pool.
+        With lsh_tables the top_k similar users are looked up approximately instead of
+        scanning all pairs, see lsh_similarity_matrix for the recall/speed knobs. Without
+        score_users only the model is built, see do_cooccurrence_algorithm
+        """
+        # step1: using cosine_similarity to calculate similar matrix
+        if lsh_tables and top_k is None:
+            raise ValueError("the approximate similar users lookup needs a top_k")
+
+        def build():
+            if lsh_tables:
+                return {'similar_matrix': lsh_similarity_matrix(self.rating_matrix, top_k, lsh_tables, lsh_bits,
+                                                                block_size=block_size)}
+            return {'similar_matrix': cosine_similarity_matrix(self.rating_matrix, top_k, block_size)}
+        parameters = {'top_k': top_k, 'lsh_tables': lsh_tables, 'lsh_bits': lsh_bits if lsh_tables else None}
+        similar_matrix = self.cached_matrices('user_based_cos_similarity', parameters, build,
+                                              ['similar_matrix'])['similar_matrix']
+        self.similar_matrix = similar_matrix
+        self.similar_top_k = top_k
+        self.user_norms = normalize_rows(self.rating_matrix)[1]
+        self.recommend_options['user_based_cos_similarity'] = top_n
+        if not score_users:
+            return
+
+        # step2: score a block of users at once, a movie's weight is the similarity
+        # weighted sum of its ratings divided by the number of users who rated it
+        self.recommend_all('user_based_cos_similarity', top_n, block_size, workers)
+
+    def similar_users_recall(self, sample=1000, seed=0):
+        """recall of the top_k similar matrix against an exact scan for a sample of users"""
+        users_count = len(self.users_list)
+        random = numpy.random.default_rng(seed)
+        sample_rows = numpy.sort(random.choice(users_count, min(sample, users_count), replace=False))
+        normalized, norms = normalize_rows(self.rating_matrix)
+        exact_block = similarity_block(normalized, normalized.T.tocsr(), norms, sample_rows)
+        return neighbor_recall(self.similar_matrix, sample_rows, exact_block, self.similar_top_k)
+
+    def cooccurrence_cap_report(self, sample=1000, seed=0):
+        """how much counting work the cooccurrence caps saved and how much they changed the
+        recommendations of a sample of users against the exact counts
+        """
+        capped = cap_watched_matrix(self.watched_matrix, **self.cooccurrence_caps)
+        users_count = len(self.users_list)
+        random = numpy.random.default_rng(seed)
+        sample_rows = numpy.sort(random.choice(users_count, min(sample, users_count), replace=False))
+        top_n = self.recommend_options['cooccurrence']
+        # exact scores without the exact matrix: r * (A.T * A) == (r * A.T) * A
+        ratings = self.rating_matrix[sample_rows]
+        exact = ratings.dot(self.watched_matrix.T).dot(self.watched_matrix)
+        exact = self.select_recommendations(sample_rows, exact.toarray(), top_n)
+        approximate = self.select_recommendations(sample_rows, self.cooccurrence_scores(sample_rows), top_n)
+        overlaps = [len(set(a.tolist()) & set(b.tolist())) / max(len(set(a.tolist()) | set(b.tolist())), 1)
+                    for a, b in zip(exact, approximate)]
+        work, capped_work = cooccurrence_work(self.watched_matrix), cooccurrence_work(capped)
+        return {"work": work, "capped_work": capped_work, "saved": 1 - capped_work / max(work, 1),
+                "users": len(sample_rows), "changed": sum(overlap < 1 for overlap in overlaps) / max(len(overlaps), 1),
+                "overlap": float(numpy.mean(overlaps)) if overlaps else 1.0}
+
+    def show_cooccurrence_cap_report(self, sample=1000):
+        report = self.cooccurrence_cap_report(sample)
         print("=" * 50)
-        print("1. Coocurrence recommender algorithm: ")
-        for user_id, user in self.users.items():
-            print(" " * 8 + "User: %-3s =>  Movies: %s" % (user_id, user.recommend_movie_ids['cooccurrence']))
+        print("Cooccurrence caps %s: %d of %d pair updates, %.1f%% saved"
+              % (self.cooccurrence_caps, report["capped_work"], report["work"], 100 * report["saved"]))
+        print("Against the exact counts %.1f%% of %d sampled users got other movies, mean overlap %.3f"
+              % (100 * report["changed"], report["users"], report["overlap"]))
+
+    def evaluate(self, k=10, holdout=0.2, seed=0, block_size=1024, workers=None):
+        """[{'algorithm', 'precision', 'recall', 'coverage', 'seconds', ...}] of every algorithm run
+
+        holdout of every user's ratings are held out, see holdout_split, the models are built
+        with this program's options on a copy holding the other ratings, then the top k movies
+        of every user are checked against the held out ones with ranking_metrics. Every
+        algorithm is a stage of the report, the time covers building and scoring
+        """
+        train, test = holdout_split(self.ratings_table, holdout, seed)
+        program = self.model_copy(train)
+        results = []
+        for algorithm, build, options in self.model_builds(program):
+            with self.stage("evaluate_" + algorithm) as info:
+                build(top_n=k, block_size=block_size, score_users=False, **options)
+                selected = [None] * len(self.users_list)
+                for user_rows, block in program.select_all(algorithm, k, block_size, workers):
+                    for u_i, movie_indices in zip(user_rows.tolist(), block):
+                        selected[u_i] = movie_indices
+                info.update(ranking_metrics(selected, test, k), algorithm=algorithm)
+            results.append(info)
+        return results
+
+    def model_copy(self, ratings_table, storage=None):
+        """a program over ratings_table with the ids of this one and no models built yet
+
+        storage defaults to this program's, the copy shares the matrix cache
+        """
+        program = type(self).__new__(type(self))
+        program.matrix_cache = self.matrix_cache
+        program.cache_hits = dict()
+        program.recommend_options = dict()
+        program.storage = storage or self.storage
+        program.dtypes = STORAGE_MODES[program.storage]
+        program.load_ratings_table(self.users_list, self.movies_list, ratings_table)
+        return program
+
+    def model_builds(self, program):
+        """[(algorithm, build method of program, options)] of every algorithm this program runs,
+        with the options it runs them with; the build methods also take top_n and score_users
+        """
+        builds = [('cooccurrence', program.do_cooccurrence_algorithm,
+                   {'max_items_per_user': self.max_items_per_user, 'max_users_per_movie': self.max_users_per_movie}),
+                  ('user_based_cos_similarity', program.do_user_based_cos_similarity_algorithm,
+                   {'top_k': self.similar_top_k, 'lsh_tables': self.lsh_tables, 'lsh_bits': self.lsh_bits})]
+        if self.item_based:
+            builds.append(('item_based_cos_similarity', program.do_item_based_cos_similarity_algorithm,
+                           {'top_k': self.item_top_k}))
+        if self.als:
+            builds.append(('als', program.do_als_algorithm,
+                           {'factors': self.als_factors, 'regularization': self.als_regularization,
+                            'iterations': self.als_iterations, 'alpha': self.als_alpha, 'threads': self.als_threads}))
+        return builds
+
+    def storage_accuracy(self, sample=1000, seed=0):
+        """[{'algorithm', 'users', 'changed', 'overlap', 'score_loss', 'bytes', 'float64_bytes'}] comparing
+        the recommendations of a sample of users against models built with float64 storage
+
+        score_loss is the largest share of a user's float64 score sum lost by picking the
+        movies this storage picked, it stays near 0 when only movies tied at the cut were
+        swapped. The float64 models are built from this program's ratings table, so ratings
+        rounded by a uint8 table are not seen here, see rounded_ratings. bytes sums the
+        matrices the algorithm's scores read, the same matrices a worker pool shares
+        """
+        exact = self.model_copy(self.ratings_table, 'float64')
+        users_count = len(self.users_list)
+        random = numpy.random.default_rng(seed)
+        sample_rows = numpy.sort(random.choice(users_count, min(sample, users_count), replace=False))
+        results = []
+        for algorithm, build, options in self.model_builds(exact):
+            if algorithm not in self.recommend_options:
+                continue
+            top_n = self.recommend_options[algorithm]
+            build(top_n=top_n, score_users=False, **options)
+            score, exact_score = (getattr(program, self.score_methods[algorithm]) for program in (self, exact))
+            exact_scores = exact_score(sample_rows)
+            picked = self.select_recommendations(sample_rows, score(sample_rows), top_n)
+            exact_picked = exact.select_recommendations(sample_rows, exact_scores, top_n)
+            overlaps = [len(set(a.tolist()) & set(b.tolist())) / max(len(set(a.tolist()) | set(b.tolist())), 1)
+                        for a, b in zip(exact_picked, picked)]
+            losses = [(row[a].sum() - row[b].sum()) / max(abs(row[a].sum()), 1e-12)
+                      for row, a, b in zip(exact_scores, exact_picked, picked)]
+            results.append({"algorithm": algorithm, "users": len(sample_rows),
+                            "changed": sum(overlap < 1 for overlap in overlaps) / max(len(overlaps), 1),
+                            "overlap": float(numpy.mean(overlaps)) if overlaps else 1.0,
+                            "score_loss": float(max(losses, default=0.0)),
+                            "bytes": sum(matrix_size(getattr(self, name))["bytes"]
+                                         for name in self.shared_matrices[algorithm]),
+                            "float64_bytes": sum(matrix_size(getattr(exact, name))["bytes"]
+                                                 for name in self.shared_matrices[algorithm])})
+        return results
+
+    def show_storage_accuracy(self, sample=1000):
+        print("=" * 50)
+        print("Storage %s against float64 for %d sampled users:" % (self.storage, min(sample, len(self.users_list))))
+        if self.rounded_ratings:
+            print("%d ratings were rounded to steps of 1/%d" % (self.rounded_ratings, RATING_STEPS))
+        print("%-28s %8s %8s %11s %11s %13s" % ("algorithm", "changed", "overlap", "score loss", "bytes",
+                                                 "float64 bytes"))
+        for result in self.storage_accuracy(sample):
+            print("%-28s %7.1f%% %8.3f %11.2e %11d %13d"
+                  % (result["algorithm"], 100 * result["changed"], result["overlap"], result["score_loss"],
+                     result["bytes"], result["float64_bytes"]))
+
+    def show_evaluation(self, results, k, holdout):
+        print("=" * 50)
+        print("Evaluation of the top %d movies, %.0f%% of every user's ratings held out:" % (k, 100 * holdout))
+        print("%-28s %12s %10s %9s %8s" % ("algorithm", "precision@%d" % k, "recall@%d" % k, "coverage", "seconds"))
+        for result in results:
+            print("%-28s %12.4f %10.4f %9.3f %8.2f" % (result["algorithm"], result["precision"], result["recall"],
+                                                       result["coverage"], result["seconds"]))
+        print("Users with held out ratings: %d" % (results[0]["users"] if results else 0))
+
+    def show_similar_users_recall(self, sample=1000):
         print("=" * 50)
-        print("2. User-based cos similarity recommendation: ")
-        for user_id, user in self.users.items():
-            print(" " * 8 + "User: %-3s =>  Movies: %s" % (user_id, user.recommend_movie_ids['user_based_cos_similarity']))
+        print("Similar users recall@%d against an exact scan of %d sampled users: %.3f"
+              % (self.similar_top_k, min(sample, len(self.users_list)), self.similar_users_recall(sample)))
+
+    def user_based_scores(self, user_rows):
+        """average similarity weighted rating of every movie for the users at user_rows"""
+        similar_rows = self.similar_matrix[user_rows]
+        if sparse.issparse(similar_rows):
+            weights = similar_rows.dot(self.rating_matrix).toarray()
+        else:
+            weights = self.rating_matrix.T.dot(similar_rows.T).T
+        counts = self.rating_matrix_csc.getnnz(axis=0)
+        scores = numpy.zeros(weights.shape, dtype=weights.dtype)
+        numpy.divide(weights, counts, out=scores, where=counts > 0)
+        return scores
+
+    def add_ratings(self, batch, block_size=1024):
+        """apply a batch of new (user_id, movie_id, rating) without rebuilding the model
+
+        a later rating of the same (user, movie) wins, also over the ratings already loaded.
+        The cooccurrence counts, user norms and the similarity rows of the touched users are
+        updated in place, then only the touched users get new recommendations: a rating also
+        shifts the weights of other users, their lists stay as they were until the next full run.
+        With a top_k similar matrix the other users' neighbor lists are merged with the new
+        similarities, a neighbor that dropped out is not replaced by a farther one. The item
+        neighbor index is precomputed and kept as it is, new movies get no neighbors. The ALS
+        factors of the other users and movies are kept, see update_als_factors
+        """
+        batch = list(batch)
+        if not batch:
+            return
+        if self.ratings_table is None:
+            self.load_ratings(*zip(*batch))
+            return
+        user_ids = numpy.array([row[0] for row in batch], dtype=numpy.int64)
+        movie_ids = numpy.array([row[1] for row in batch], dtype=numpy.int64)
+        ratings = numpy.array([row[2] for row in batch], dtype=numpy.float64)
+
+        # step1: append the users and movies seen for the first time
+        for ids, id_list, index, objects, cls in ((user_ids, self.users_list, self.user_index, self.users, User),
+                                                  (movie_ids, self.movies_list, self.movie_index, self.movies, Movie)):
+            for new_id in first_seen_order(ids)[0]:
+                if new_id not in index:
+                    index[new_id] = len(id_list)
+                    objects[new_id] = cls(new_id, len(id_list), self)
+                    id_list.append(new_id)
+        user_rows = numpy.array([self.user_index[user_id] for user_id in user_ids.tolist()], dtype=numpy.int64)
+        movie_cols = numpy.array([self.movie_index[movie_id] for movie_id in movie_ids.tolist()], dtype=numpy.int64)
+        old_users_count, old_movies_count = self.ratings_table.shape
+        users_count, movies_count = len(self.users_list), len(self.movies_list)
+        touched = numpy.unique(user_rows)
+        old_touched = touched[touched < old_users_count]
+        old_watched = self.watched_matrix[old_touched]
+        old_watched.resize((len(old_touched), movies_count))
+
+        # step2: merge the batch into the ratings table, the last rating of a pair wins
+        keys = user_rows * movies_count + movie_cols
+        _, last = numpy.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        table = self.ratings_table.tocoo()
+        table_keys = table.row.astype(numpy.int64) * movies_count + table.col
+        kept = ~numpy.isin(table_keys, keys[last])
+        self.ratings_table = self.stored_table(sparse.csr_matrix(
+            (numpy.concatenate([table.data[kept], encode_ratings(ratings[last], table.dtype)]),
+             (numpy.concatenate([table.row[kept], user_rows[last]]),
+              numpy.concatenate([table.col[kept], movie_cols[last]]))),
+            shape=(users_count, movies_count), dtype=table.dtype))
+        self.build_rating_matrices()
+
+        # step3: cooccurrence counts only change by the touched users' rows of A.T * A
+        if self.cooccurrence_matrix is not None:
+            self.update_cooccurrence_matrix(old_watched, touched)
+
+        # step4: new norms and similarity rows for the touched users
+        if self.similar_matrix is not None:
+            self.update_similar_matrix(touched, block_size)
+
+        # step5: solve the factors of the touched users and of the batch's movies again
+        if self.user_factors is not None:
+            self.update_als_factors(touched, numpy.unique(movie_cols))
+
+        # step6: recommend again for the touched users only
+        # with the item neighbor index as it is, new movies have no neighbors yet
+        if self.item_neighbors is not None:
+            self.item_neighbors.resize((movies_count, movies_count))
+        for start in range(0, len(touched), block_size):
+            rows = touched[start:start + block_size]
+            for algorithm, top_n in self.recommend_options.items():
+                scores = getattr(self, self.score_methods[algorithm])(rows)
+                self.store_recommendations(algorithm, rows, scores, top_n)
+
+    def update_cooccurrence_matrix(self, old_watched, touched):
+        """C += A_new[touched].T * A_new[touched] - A_old[touched].T * A_old[touched]
+
+        the per user cap is applied to both sides, the per movie cap is only applied
+        when the whole matrix is built
+        """
+        movies_count = len(self.movies_list)
+        max_items_per_user = (self.cooccurrence_caps or {}).get('max_items_per_user')
+        added = cap_watched_matrix(self.watched_matrix[touched], max_items_per_user, user_rows=touched)
+        old_watched = cap_watched_matrix(old_watched, max_items_per_user, user_rows=touched[:old_watched.shape[0]])
+        delta = (added.T.tocsr() * added - old_watched.T.tocsr() * old_watched).tocoo()
+        matrix = self.cooccurrence_matrix
+        if isinstance(matrix, BlockedMatrix):
+            if matrix.shape[0] < movies_count:
+                matrix = cooccurrence_blocks(cap_watched_matrix(self.watched_matrix, **self.cooccurrence_caps),
+                                             matrix.directory, matrix.movie_block, matrix.counts_dtype)
+            else:
+                delta = delta.tocsc()
+                for k, (start, stop, _, _) in enumerate(matrix.blocks):
+                    block = (matrix.block(k) + delta[:, start:stop]).tocsr()
+                    block.eliminate_zeros()
+                    matrix.save_block(k, block)
+        elif sparse.issparse(matrix):
+            counts_dtype = matrix.dtype
+            matrix = writable(matrix.tocsr())
+            matrix.resize((movies_count, movies_count))
+            matrix = (matrix + delta).tocsr()
+            matrix.eliminate_zeros()
+            matrix = narrow_counts(matrix, counts_dtype)
+        else:
+            if matrix.shape[0] < movies_count:
+                padded = numpy.zeros((movies_count, movies_count), dtype=matrix.dtype)
+                padded[:matrix.shape[0], :matrix.shape[1]] = matrix
+                matrix = padded
+            matrix = writable(matrix)
+            # delta has one entry per pair, a count that outgrows a narrow dtype widens the matrix
+            counts = matrix[delta.row, delta.col].astype(numpy.int64) + delta.data
+            if counts.size and counts.max() > numpy.iinfo(matrix.dtype).max:
+                matrix = matrix.astype(numpy.int64)
+            matrix[delta.row, delta.col] = counts
+        self.cooccurrence_matrix = matrix
+
+    def update_similar_matrix(self, touched, block_size=1024):
+        """recompute the similarity of the touched users with every user, see add_ratings"""
+        users_count = len(self.users_list)
+        norms = numpy.zeros(users_count)
+        norms[:len(self.user_norms)] = self.user_norms
+        touched_ratings = self.rating_matrix[touched]
+        norms[touched] = numpy.sqrt(numpy.asarray(touched_ratings.multiply(touched_ratings).sum(axis=1)).ravel())
+        self.user_norms = norms
+        scale = numpy.zeros(users_count, dtype=self.rating_matrix.dtype)
+        scale[norms > 0] = 1 / norms[norms > 0]
+        normalized = sparse.diags(scale).dot(self.rating_matrix).tocsr()
+        normalized_t = normalized.T.tocsr()
+
+        similar_matrix = self.similar_matrix
+        top_k = self.similar_top_k
+        if top_k is None:
+            if similar_matrix.shape[0] < users_count:
+                padded = numpy.zeros((users_count, users_count), dtype=similar_matrix.dtype)
+                padded[:similar_matrix.shape[0], :similar_matrix.shape[1]] = similar_matrix
+                similar_matrix = padded
+            similar_matrix = writable(similar_matrix)
+            for start in range(0, len(touched), block_size):
+                block_rows = touched[start:start + block_size]
+                block = similarity_block(normalized, normalized_t, norms, block_rows)
+                similar_matrix[block_rows] = block
+                similar_matrix[:, block_rows] = block.T
+            self.similar_matrix = similar_matrix
+            return
+
+        # keep the untouched rows' neighbors that are not touched, the touched users
+        # get fresh rows and are offered as neighbors to every other row
+        similar_matrix = similar_matrix.tocoo()
+        is_touched = numpy.zeros(users_count, dtype=bool)
+        is_touched[touched] = True
+        kept = ~is_touched[similar_matrix.row] & ~is_touched[similar_matrix.col]
+        neighbors = [(similar_matrix.row[kept].astype(numpy.int64), similar_matrix.col[kept].astype(numpy.int64),
+                      similar_matrix.data[kept])]
+        for start in range(0, len(touched), block_size):
+            block_rows = touched[start:start + block_size]
+            block = similarity_block(normalized, normalized_t, norms, block_rows)
+            offered_rows, offered_cols = numpy.nonzero(block > 0)
+            offered = ~is_touched[offered_cols]
+            neighbors.append((offered_cols[offered], block_rows[offered_rows[offered]],
+                              block[offered_rows[offered], offered_cols[offered]]))
+            neighbors.append(top_k_neighbors(block, block_rows, top_k))
+        rows, cols, values = (numpy.concatenate(part) for part in zip(*neighbors))
+        self.similar_matrix = keep_top_k(rows, cols, values, top_k, (users_count, users_count))
+
+    def do_item_based_cos_similarity_algorithm(self, top_k=50, top_n=None, block_size=1024, workers=None,
+                                               score_users=True):
+        """Item based cos similarity recommendation algorithm
+
+        every movie keeps only its top_k most similar movies, a user's weight for a movie is
+        the similarity weighted average of the user's ratings of the movies it neighbors,
+        so a user's scores only read the neighbor rows of the movies the user rated.
+        An index loaded by read_item_neighbors is used as it is, else it is built here.
+        Without score_users only the index is built, see do_cooccurrence_algorithm
+        """
+        # step1: cosine similarity between movie columns, pruned to top_k neighbors per movie
+        if self.item_neighbors is None:
+            self.item_neighbors = self.cached_matrices(
+                'item_based_cos_similarity', {'top_k': top_k},
+                lambda: {'item_neighbors': cosine_similarity_matrix(self.rating_matrix.T.tocsr(), top_k, block_size)},
+                ['item_neighbors'])['item_neighbors']
+        self.recommend_options['item_based_cos_similarity'] = top_n
+        if not score_users:
+            return
+
+        # step2: score a block of users at once from the neighbors of the movies they rated
+        self.recommend_all('item_based_cos_similarity', top_n, block_size, workers)
+
+    def item_based_scores(self, user_rows):
+        """neighbor similarity weighted average rating of every movie for the users at user_rows"""
+        ratings = self.rating_matrix[user_rows]
+        rated = sparse.csr_matrix((numpy.ones(ratings.nnz), ratings.indices, ratings.indptr), shape=ratings.shape)
+        weights = ratings.dot(self.item_neighbors).toarray()
+        similarity_sums = rated.dot(self.item_neighbors).toarray()
+        scores = numpy.zeros(weights.shape, dtype=weights.dtype)
+        numpy.divide(weights, similarity_sums, out=scores, where=similarity_sums > 0)
+        return scores
+
+    def save_item_neighbors(self, path):
+        """write the item neighbor index with its movie ids to a binary file, see read_item_neighbors"""
+        neighbors = self.item_neighbors
+        save_columns(path, shape=list(neighbors.shape),
+                     movies=numpy.asarray(self.movies_list, dtype=numpy.int64),
+                     indptr=neighbors.indptr.astype(numpy.int64),
+                     indices=neighbors.indices.astype(numpy.int32),
+                     similarities=neighbors.data.astype(numpy.float64))
+
+    def read_item_neighbors(self, path):
+        """load the item neighbor index written by save_item_neighbors for the loaded movies
+
+        the columns are memory-mapped; if the movies differ from the saved ones the index is
+        mapped onto the loaded movies, a movie unknown to the index has no neighbors
+        """
+        header, columns = load_columns(path)
+        neighbors = sparse.csr_matrix((columns["similarities"], columns["indices"], columns["indptr"]),
+                                      shape=tuple(header["shape"]), copy=False)
+        saved_movies = columns["movies"].tolist()
+        movies_count = len(self.movies_list)
+        if saved_movies != self.movies_list:
+            position = numpy.array([self.movie_index.get(movie_id, -1) for movie_id in saved_movies],
+                                   dtype=numpy.int64)
+            neighbors = neighbors.tocoo()
+            rows, cols = position[neighbors.row], position[neighbors.col]
+            known = (rows >= 0) & (cols >= 0)
+            neighbors = sparse.csr_matrix((neighbors.data[known], (rows[known], cols[known])),
+                                          shape=(movies_count, movies_count))
+        self.item_neighbors = neighbors
+
+    def do_als_algorithm(self, factors=32, regularization=10.0, iterations=10, alpha=10.0, threads=None,
+                         top_n=None, block_size=1024, workers=None, score_users=True):
+        """ALS matrix factorization recommendation algorithm
+
+        learns factors users x factors and movies x factors so that a user's factors dotted
+        with a movie's come close to 1 for a watched movie and 0 for the rest, a watched
+        movie weighs 1 + alpha * rating in the squared error, see als_factors. The model
+        takes (users + movies) * factors floats, a user's score for every movie is one
+        product with the movie factors. threads solve the batches of users and movies in
+        parallel, workers score the users in processes. Without score_users only the
+        factors are learned, see do_cooccurrence_algorithm
+        """
+        # step1: alternate solving the user factors and the movie factors
+        self.als_options = {'regularization': regularization, 'alpha': alpha, 'threads': threads}
+        def build():
+            user_factors, movie_factors = als_factors(self.als_confidence(), factors, regularization, iterations,
+                                                      threads=threads)
+            return {'user_factors': user_factors.astype(self.dtypes['ratings']),
+                    'movie_factors': movie_factors.astype(self.dtypes['ratings'])}
+        parameters = {'factors': factors, 'regularization': regularization, 'iterations': iterations, 'alpha': alpha}
+        matrices = self.cached_matrices('als', parameters, build, ['user_factors', 'movie_factors'])
+        self.user_factors, self.movie_factors = matrices['user_factors'], matrices['movie_factors']
+        self.recommend_options['als'] = top_n
+        if not score_users:
+            return
+
+        # step2: score a block of users at once against the movie factors
+        self.recommend_all('als', top_n, block_size, workers)
+
+    def als_confidence(self):
+        """users x movies csr_matrix of 1 + alpha * rating for every watched movie, 0.0 ratings included"""
+        table = self.ratings_table
+        return sparse.csr_matrix((1.0 + self.als_options['alpha'] * decode_ratings(table.data), table.indices,
+                                  table.indptr),
+                                 shape=table.shape)
+
+    def als_scores(self, user_rows):
+        """predicted preference of every movie for the users at user_rows"""
+        return self.user_factors[user_rows].dot(self.movie_factors.T)
+
+    def update_als_factors(self, touched, movie_cols):
+        """solve the factors of the touched users, then of the movies at movie_cols, see add_ratings
+
+        the other factors stay fixed, new users and movies start from zero factors
+        """
+        users_count, movies_count = self.ratings_table.shape
+        factors = self.user_factors.shape[1]
+        for name, count in (('user_factors', users_count), ('movie_factors', movies_count)):
+            matrix = writable(getattr(self, name))
+            if matrix.shape[0] < count:
+                matrix = numpy.vstack([matrix, numpy.zeros((count - matrix.shape[0], factors), dtype=matrix.dtype)])
+            setattr(self, name, matrix)
+        confidence_matrix = self.als_confidence()
+        regularization, threads = self.als_options['regularization'], self.als_options['threads']
+        self.user_factors[touched] = solve_als_side(confidence_matrix, self.movie_factors, regularization,
+                                                    touched, threads)
+        self.movie_factors[movie_cols] = solve_als_side(confidence_matrix.T.tocsr(), self.user_factors,
+                                                        regularization, movie_cols, threads)
+
+    def recommend_all(self, algorithm, top_n=None, block_size=1024, workers=None):
+        """score and store the recommendations of algorithm for every user, a block of users at once"""
+        for user_rows, selected in self.select_all(algorithm, top_n, block_size, workers):
+            self.save_recommendations(algorithm, user_rows, selected, top_n)
+
+    def select_all(self, algorithm, top_n=None, block_size=1024, workers=None):
+        """yield (user_rows, [movie indices]) to recommend to every block of users, in any order
+        if workers score the blocks
+        """
+        if workers and workers > 1:
+            yield from self.select_in_pool(algorithm, top_n, block_size, workers)
+            return
+        users_count = len(self.users_list)
+        score = getattr(self, self.score_methods[algorithm])
+        for start in range(0, users_count, block_size):
+            user_rows = numpy.arange(start, min(start + block_size, users_count))
+            yield user_rows, self.select_recommendations(user_rows, score(user_rows), top_n)
+
+    def recommend_users(self, user_ids, algorithm='cooccurrence'):
+        """[movie ids] to recommend to every user of user_ids, all scored in one block"""
+        user_rows = numpy.array([self.user_index[user_id] for user_id in user_ids], dtype=numpy.int64)
+        top_n = self.recommend_options[algorithm]
+        scores = getattr(self, self.score_methods[algorithm])(user_rows)
+        recommendations = []
+        for selected in self.select_recommendations(user_rows, scores, top_n):
+            recommend_movie_ids = [self.movies_list[m_j] for m_j in selected.tolist()]
+            if top_n is None:
+                recommend_movie_ids.sort()
+            recommendations.append(recommend_movie_ids)
+        return recommendations
+
+    def select_in_pool(self, algorithm, top_n=None, block_size=1024, workers=2):
+        """select_all with the blocks of users spread over workers
+
+        the matrices the scores read are put in shared memory once instead of being
+        pickled to every worker, only the picked movie indices travel back
+        """
+        users_count = len(self.users_list)
+        blocks, specs = share_matrices({name: getattr(self, name) for name in self.shared_matrices[algorithm]})
+        try:
+            tasks = [(algorithm, start, min(start + block_size, users_count), top_n)
+                     for start in range(0, users_count, block_size)]
+            with multiprocessing.Pool(workers, init_worker, (specs,)) as pool:
+                for start, selected in pool.imap_unordered(recommend_user_range, tasks):
+                    yield numpy.arange(start, start + len(selected)), selected
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def select_recommendations(self, user_rows, scores, top_n=None):
+        """[movie indices] to recommend to every user of user_rows given their scores"""
+        watched_matrix = self.watched_matrix[user_rows]
+        if top_n is None:
+            return best_movie_indices(scores, watched_matrix)
+        return top_movie_indices(scores, watched_matrix, top_n)
+
+    def store_recommendations(self, algorithm, user_rows, scores, top_n=None):
+        """pick the movies to recommend from the scores of user_rows and save them on the users"""
+        selected = self.select_recommendations(user_rows, scores, top_n)
+        self.save_recommendations(algorithm, user_rows, selected, top_n)
+
+    def save_recommendations(self, algorithm, user_rows, selected, top_n=None):
+        """save the movies at the selected indices on the users of user_rows, or stream them
+        to the output_writer if there is one
+        """
+        movies_array = numpy.asarray(self.movies_list)
+        recommendations = []
+        for movie_indices in selected:
+            recommend_movie_ids = movies_array[movie_indices].tolist()
+            if top_n is None:
+                recommend_movie_ids.sort()
+            recommendations.append(recommend_movie_ids)
+        user_ids = [self.users_list[u_i] for u_i in user_rows]
+        if self.output_writer is not None:
+            self.output_writer.write(algorithm, user_ids, recommendations)
+            return
+        for user_id, recommend_movie_ids in zip(user_ids, recommendations):
+            self.users[user_id].recommend_movie_ids[algorithm] = recommend_movie_ids
+
+    def show_result(self, chunk_size=10000):
+        titles = [('cooccurrence', "Coocurrence recommender algorithm: "),
+                  ('user_based_cos_similarity', "User-based cos similarity recommendation: "),
+                  ('item_based_cos_similarity', "Item-based cos similarity recommendation: "),
+                  ('als', "ALS matrix factorization recommendation: ")]
+        titles = [(algorithm, title) for algorithm, title in titles if algorithm in self.recommend_options]
+        users = list(self.users.items())
+        for number, (algorithm, title) in enumerate(titles, 1):
+            print("=" * 50)
+            print("%d. %s" % (number, title))
+            # one write per chunk of users instead of one print per user
+            for start in range(0, len(users), chunk_size):
+                sys.stdout.write("".join(" " * 8 + "User: %-3s =>  Movies: %s\n"
+                                         % (user_id, user.recommend_movie_ids[algorithm])
+                                         for user_id, user in users[start:start + chunk_size]))
 
 main = MovieRecommendationProgram
 
+
+class RecommendationServer(object):
+    """answer recommendation requests from a loaded MovieRecommendationProgram on a local socket
+
+    every request and answer is one json line:
+        {"user_id": 1, "algorithm": "cooccurrence"}
+            => {"user_id": 1, "algorithm": "cooccurrence", "movie_ids": [...]}
+        {"ratings": [[user_id, movie_id, rating], ...]} => {"added": 2}
+    an answer is looked up in an LRU cache first, the cached answers of a user are
+    dropped when ratings of that user arrive. Cache misses wait up to max_wait seconds
+    for other misses of the same algorithm and are scored together, up to max_batch_size
+    users in one matrix product. A client may send the next request before its answer
+    came back, answers keep the order of the requests. A line longer than
+    max_request_bytes is skipped and answered with an error
+    """
+
+    def __init__(self, program, cache_size=10000, max_batch_size=64, max_wait=0.002, max_request_bytes=1 << 24):
+        self.program = program
+        self.cache_size = cache_size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_request_bytes = max_request_bytes
+        self.cache = OrderedDict() # {(algorithm, user_id) : [recommend_movie_id]}, least recently used first
+        self.pending = defaultdict(list) # {'algorithm' : [(user_id, <Future>)]} waiting to be scored
+        self.flush_timers = dict() # {'algorithm' : <TimerHandle>} of the pending batch
+
+    def cached(self, user_id, algorithm):
+        key = (algorithm, user_id)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        return None
+
+    def remember(self, user_id, algorithm, recommend_movie_ids):
+        self.cache[(algorithm, user_id)] = recommend_movie_ids
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def recommend_batched(self, user_id, algorithm='cooccurrence'):
+        """movie ids to recommend to user_id, a cache miss joins the pending batch of algorithm"""
+        recommend_movie_ids = self.cached(user_id, algorithm)
+        if recommend_movie_ids is not None:
+            return recommend_movie_ids
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending[algorithm]
+        batch.append((user_id, future))
+        if len(batch) >= self.max_batch_size:
+            self.flush(algorithm)
+        elif algorithm not in self.flush_timers:
+            self.flush_timers[algorithm] = loop.call_later(self.max_wait, self.flush, algorithm)
+        return await future
+
+    def flush(self, algorithm):
+        """score the pending batch of algorithm in one block and answer its futures"""
+        timer = self.flush_timers.pop(algorithm, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(algorithm, [])
+        if not batch:
+            return
+        try:
+            recommendations = self.program.recommend_users([user_id for user_id, _ in batch], algorithm)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (user_id, future), recommend_movie_ids in zip(batch, recommendations):
+            self.remember(user_id, algorithm, recommend_movie_ids)
+            if not future.done():
+                future.set_result(recommend_movie_ids)
+
+    def invalid_ratings_reason(self, ratings):
+        """the error message why a ratings request is invalid, None if every row is valid
+
+        rows follow the rules of invalid_reason on the text of their values, so an id must
+        be a non-negative int64 and the rating a number from 0.0 to 5.0
+        """
+        if not isinstance(ratings, list):
+            return "Invalid request: ratings is not a list."
+        for i, row in enumerate(ratings):
+            if not isinstance(row, list):
+                return "Invalid request: ratings row %d is not a list." % i
+            message = self.program.invalid_reason([str(value) for value in row])
+            if message:
+                return "%s Ratings row %d: %s" % (message, i, json.dumps(row))
+        return None
+
+    def add_ratings(self, ratings):
+        ratings = [(int(user_id), int(movie_id), float(rating)) for user_id, movie_id, rating in ratings]
+        self.program.add_ratings(ratings)
+        for user_id in set(row[0] for row in ratings):
+            for algorithm in self.program.recommend_options:
+                self.cache.pop((algorithm, user_id), None)
+        return len(ratings)
+
+    async def answer(self, request):
+        """the answer to one decoded request"""
+        if "ratings" in request:
+            message = self.invalid_ratings_reason(request["ratings"])
+            if message:
+                return {"error": message}
+            return {"added": self.add_ratings(request["ratings"])}
+        user_id = request.get("user_id")
+        algorithm = request.get("algorithm", 'cooccurrence')
+        if algorithm not in self.program.recommend_options:
+            return {"error": "Invalid request: unknown algorithm '%s'." % algorithm}
+        if user_id not in self.program.user_index:
+            return {"error": "Invalid request: unknown user_id '%s'." % user_id}
+        return {"user_id": user_id, "algorithm": algorithm,
+                "movie_ids": await self.recommend_batched(user_id, algorithm)}
+
+    async def answer_line(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"error": "Invalid request: not a json line."}
+        if not isinstance(request, dict):
+            return {"error": "Invalid request: not a json object."}
+        try:
+            return await self.answer(request)
+        except (TypeError, ValueError) as e:
+            return {"error": "Invalid request: %s." % e}
+        except Exception as e:
+            # an answer that fails must not end the connection, later requests still get theirs
+            return {"error": "Failed request: %s: %s." % (type(e).__name__, e)}
+
+    async def write_answers(self, answers, writer):
+        """write the answers of a connection in request order, None ends the connection
+
+        once the client is gone the answers are still taken off the queue, so the
+        reading side never waits on a full queue
+        """
+        connected = True
+        while True:
+            answer = await answers.get()
+            if answer is None:
+                return
+            answer = await answer
+            if connected:
+                try:
+                    writer.write(json.dumps(answer).encode() + b"\n")
+                    await writer.drain()
+                except ConnectionError:
+                    connected = False
+
+    async def read_request(self, reader):
+        """the next request line of reader, b"" at the end, None for a line over the reader's limit
+
+        a long line is skipped up to its newline, the requests after it are read as usual
+        """
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return e.partial  # the last line may come without a newline
+        except asyncio.LimitOverrunError:
+            pass
+        while True:
+            try:
+                await reader.readuntil(b"\n")
+                return None
+            except asyncio.LimitOverrunError as e:
+                await reader.readexactly(e.consumed)
+            except asyncio.IncompleteReadError:
+                return None
+
+    async def handle_connection(self, reader, writer):
+        # requests of one connection are answered concurrently, so they can share a batch
+        answers = asyncio.Queue(self.max_batch_size * 4)
+        writing = asyncio.ensure_future(self.write_answers(answers, writer))
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await self.read_request(reader)
+                if line is None:
+                    answer = loop.create_future()
+                    answer.set_result({"error": "Invalid request: longer than %d bytes." % self.max_request_bytes})
+                elif not line:
+                    break
+                else:
+                    answer = asyncio.ensure_future(self.answer_line(line))
+                await answers.put(answer)
+        except ConnectionError:
+            pass
+        finally:
+            # the answers already queued are still written before the connection closes
+            await answers.put(None)
+            await writing
+            writer.close()
+
+    async def serve_forever(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=self.max_request_bytes)
+        print("Serving recommendations on %s:%d" % (host, port))
+        sys.stdout.flush()
+        async with server:
+            await server.serve_forever()
+
+    def serve(self, host="127.0.0.1", port=8765):
+        try:
+            asyncio.run(self.serve_forever(host, port))
+        except KeyboardInterrupt:
+            pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Movie recommendation System, ratings are read from stdin or MongoDB")
+    parser.add_argument("--top-n", type=int, default=None,
+                        help="recommend the n best movies of every user instead of the tied best ones")
+    parser.add_argument("--bulk", action="store_true",
+                        help="parse the ratings in large chunks and report invalid lines in one summary")
+    parser.add_argument("--snapshot", metavar="PATH",
+                        help="read the ratings from a snapshot written by --save-snapshot instead of stdin")
+    parser.add_argument("--save-snapshot", metavar="PATH",
+                        help="write the parsed ratings to a binary snapshot file")
+    parser.add_argument("--item-based", action="store_true",
+                        help="also recommend with item-based cos similarity over a top-k neighbor index")
+    parser.add_argument("--item-neighbors", metavar="PATH",
+                        help="read the item neighbor index from a file written by --save-item-neighbors")
+    parser.add_argument("--save-item-neighbors", metavar="PATH",
+                        help="write the item neighbor index to a binary file")
+    parser.add_argument("--similar-top-k", type=int, default=None,
+                        help="keep only the k most similar users of every user")
+    parser.add_argument("--item-top-k", type=int, default=50,
+                        help="keep only the k most similar movies of every movie in the item neighbor index")
+    parser.add_argument("--lsh-tables", type=int, default=None,
+                        help="look the similar users up approximately with this many LSH tables, needs --similar-top-k")
+    parser.add_argument("--lsh-bits", type=int, default=8,
+                        help="bits of every LSH table, more bits are faster and find fewer neighbors")
+    parser.add_argument("--recall-report", action="store_true",
+                        help="print the recall of the similar users against an exact scan of a sample")
+    parser.add_argument("--serve", type=int, metavar="PORT", default=None,
+                        help="keep the model loaded and answer json line requests on this local port")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address --serve listens on")
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="recommendations --serve keeps in its LRU cache")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="users --serve scores together in one matrix product at most")
+    parser.add_argument("--max-request-kb", type=int, default=16384,
+                        help="longest request line --serve reads, longer ones are answered with an error")
+    parser.add_argument("--batch-wait", type=float, default=2.0,
+                        help="milliseconds a --serve request waits for others to batch with")
+    parser.add_argument("--report", metavar="PATH",
+                        help="write the time, rows, matrix sizes and peak memory of every stage as json, - for stderr")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a cProfile dump of every stage to this directory")
+    parser.add_argument("--output", metavar="PATH",
+                        help="stream the recommendations to this file while scoring instead of printing them")
+    parser.add_argument("--output-format", choices=sorted(OUTPUT_WRITERS),
+                        help="format of --output, by default its extension: .csv, .jsonl or .bin, csv for none")
+    parser.add_argument("--out-of-core", metavar="DIR",
+                        help="spill the cooccurrence matrix to memory-mapped blocks in this directory")
+    parser.add_argument("--movie-block", type=int, default=4096,
+                        help="movies of every --out-of-core block")
+    parser.add_argument("--max-items-per-user", type=int, default=None,
+                        help="count the cooccurrence on a sample of this many movies of every heavy user")
+    parser.add_argument("--max-users-per-movie", type=int, default=None,
+                        help="count the cooccurrence on a sample of this many users of every popular movie")
+    parser.add_argument("--cap-report", action="store_true",
+                        help="print the work the caps saved and how the recommendations changed")
+    parser.add_argument("--als", action="store_true",
+                        help="also recommend with an ALS matrix factorization of the watched movies")
+    parser.add_argument("--als-factors", type=int, default=32,
+                        help="factors of every user and movie in --als")
+    parser.add_argument("--als-iterations", type=int, default=10,
+                        help="rounds of solving the user and then the movie factors in --als")
+    parser.add_argument("--als-regularization", type=float, default=10.0,
+                        help="weight of the factors' squared length in the --als loss")
+    parser.add_argument("--als-alpha", type=float, default=10.0,
+                        help="a watched movie weighs 1 + alpha * rating in the --als loss")
+    parser.add_argument("--als-threads", type=int, default=None,
+                        help="solve the --als batches on this many threads")
+    parser.add_argument("--matrix-cache", metavar="DIR",
+                        help="keep built matrices in this directory and reuse them while the ratings are unchanged")
+    parser.add_argument("--matrix-cache-mb", type=int, default=1024,
+                        help="remove the least recently used --matrix-cache entries beyond this size")
+    parser.add_argument("--evaluate", type=int, metavar="K", default=None,
+                        help="only print precision@k, recall@k and coverage of every algorithm on held out ratings")
+    parser.add_argument("--holdout", type=float, default=0.2,
+                        help="share of every user's ratings --evaluate holds out")
+    parser.add_argument("--storage", choices=sorted(STORAGE_MODES), default="float64",
+                        help="float32 ratings and int32 counts, or compact: uint8 ratings table and uint16 counts")
+    parser.add_argument("--storage-report", action="store_true",
+                        help="print how the --storage mode changed the recommendations against float64")
+    parser.add_argument("--mongo", metavar="URI",
+                        help="read the ratings from this MongoDB server instead of stdin, needs pymongo")
+    parser.add_argument("--mongo-db", default="test_database",
+                        help="database of the --mongo ratings collection")
+    parser.add_argument("--mongo-collection", default="ratings",
+                        help="collection of the --mongo ratings documents")
+    parser.add_argument("--mongo-fields", default="user_id,movie_id,rating",
+                        help="names of the user id, movie id and rating fields of the --mongo documents")
+    parser.add_argument("--mongo-batch-size", type=int, default=50000,
+                        help="documents of every raw BSON batch a --mongo cursor gets")
+    parser.add_argument("--mongo-partitions", type=int, default=1,
+                        help="read the --mongo user id range with this many cursors at once")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="score the users in this many worker processes")
+    args = parser.parse_args()
+    if args.lsh_tables and args.similar_top_k is None:
+        parser.error("--lsh-tables needs --similar-top-k")
+    if args.output and args.output_format is None:
+        try:
+            output_format_of(args.output)
+        except ValueError as e:
+            parser.error("--output: %s" % e)
+    return args
+
+
 if __name__ == '__main__':
+    args = parse_args()
     print("\n" * 2 + "*" * 50)
     print(" " * 12 + "Movie recommendation System")
     print(" " * 14 + "Program 1, Wendi Weng")
     print("*" * 50 + "\n")
-    main()
+    main(top_n=args.top_n, bulk_ingest=args.bulk, snapshot=args.snapshot, save_snapshot_to=args.save_snapshot,
+         workers=args.workers, item_based=args.item_based, item_neighbors_from=args.item_neighbors,
+         save_item_neighbors_to=args.save_item_neighbors, item_top_k=args.item_top_k,
+         similar_top_k=args.similar_top_k, lsh_tables=args.lsh_tables, lsh_bits=args.lsh_bits,
+         recall_report=args.recall_report, serve_port=args.serve, serve_host=args.host, cache_size=args.cache_size,
+         max_batch_size=args.batch_size, max_wait=args.batch_wait / 1000.0, max_request_bytes=args.max_request_kb << 10,
+         report_to=args.report, profile_to=args.profile, output_to=args.output,
+         output_format=args.output_format, out_of_core_dir=args.out_of_core, movie_block=args.movie_block,
+         max_items_per_user=args.max_items_per_user, max_users_per_movie=args.max_users_per_movie,
+         cap_report=args.cap_report, als=args.als, als_factors=args.als_factors,
+         als_iterations=args.als_iterations, als_regularization=args.als_regularization, als_alpha=args.als_alpha,
+         als_threads=args.als_threads, matrix_cache_dir=args.matrix_cache,
+         matrix_cache_bytes=args.matrix_cache_mb << 20, evaluate_k=args.evaluate, holdout=args.holdout,
+         storage=args.storage, storage_report=args.storage_report, mongo_uri=args.mongo,
+         mongo_database=args.mongo_db, mongo_collection=args.mongo_collection,
+         mongo_fields=tuple(x.strip() for x in args.mongo_fields.split(",")), mongo_batch_size=args.mongo_batch_size,
+         mongo_partitions=args.mongo_partitions)
     print("\n" + "*" * 50)
     print(" " * 22 + "Done")
     print("*" * 50 + "\n")
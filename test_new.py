@@ -0,0 +1,444 @@
+import asyncio
+import io
+import json
+import math
+import random
+import sys
+
+import numpy
+import pytest
+
+import new
+from new import (MongoRatingsSource, MovieRecommendationProgram, RecommendationServer, output_format_of,
+                 parse_bson_ratings)
+
+
+class LoadOnlyProgram(MovieRecommendationProgram):
+    """MovieRecommendationProgram that only loads the ratings it is given"""
+
+    def run(self):
+        pass
+
+
+AWKWARD_LINES = [
+    "1,2,3",
+    " 1 , 2 , 4.5 # comment",
+    "1,2,2.5",  # a later rating of the same pair wins
+    "007,010,1e0",
+    "3,4,5.",
+    "3,5,.5",
+    "3,6,+3",
+    "3,7,-1",
+    "3,8,5.01",
+    "3,9,nan",
+    "3,10,inf",
+    "3,11,",
+    "3,abc,2",
+    "x,1,2",
+    "1,2",
+    "1,2,3,4",
+    "",
+    "# only a comment",
+    "4\t,\t5,\t3\r",
+    "٣,5,2",
+    "²,5,2",
+    "999999999999999999,1,1",
+    "9223372036854775807,1,1",
+    "9223372036854775808,1,1",
+    "12345678901234567890123,2,3",
+    "5,12345678901234567890123,3",
+    "6,7,1234567890123456789012345.0",
+]
+
+
+def load(lines, bulk):
+    program = LoadOnlyProgram()
+    data = "".join(line + "\n" for line in lines)
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdin, sys.stdout = io.StringIO(data), io.StringIO()
+    try:
+        if bulk:
+            program.read_data_bulk(io.BytesIO(data.encode()), chunk_size=64)
+        else:
+            program.read_data()
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
+    return program
+
+
+def assert_same_ratings(lines):
+    plain, bulk = load(lines, False), load(lines, True)
+    assert plain.users_list == bulk.users_list
+    assert plain.movies_list == bulk.movies_list
+    assert numpy.array_equal(plain.ratings_table.toarray(), bulk.ratings_table.toarray())
+    return plain
+
+
+def test_bulk_matches_read_data_on_awkward_lines():
+    program = assert_same_ratings(AWKWARD_LINES)
+    assert 12345678901234567890123 not in program.users_list
+    assert 9223372036854775807 in program.users_list
+    assert program.ratings_table[program.user_index[1], program.movie_index[2]] == 2.5
+    assert not numpy.isnan(program.ratings_table.data).any()
+
+
+def test_bulk_matches_read_data_on_random_lines():
+    random_state = random.Random(0)
+    parts = ["1", "2", "17", "007", "3.5", "5", "6", "-1", "nan", "1e0", ".", "", " ", "abc", "#x",
+             "99999999999999999999", "9223372036854775808", "4.25"]
+    for _ in range(300):
+        lines = [",".join(random_state.choice(parts) for _ in range(random_state.choice([2, 3, 3, 3, 4])))
+                 for _ in range(random_state.randint(1, 8))]
+        assert_same_ratings(lines)
+
+
+def test_server_rejects_invalid_ratings():
+    program = LoadOnlyProgram()
+    program.load_ratings([1, 1, 2, 3], [10, 11, 10, 12], [4.0, 3.0, 5.0, 2.0])
+    program.do_cooccurrence_algorithm(score_users=False)
+    server = RecommendationServer(program)
+
+    def answer(request):
+        return asyncio.run(server.answer_line(json.dumps(request).encode()))
+
+    for ratings in ([[1, 2, 9]], [[-1, 2, 3]], [[1, 2, float("nan")]], [[1, 2]], [[1, 2.5, 3]], [1, 2, 3],
+                    [[99999999999999999999999, 1, 3]], "1,2,3"):
+        assert "error" in answer({"ratings": ratings}), ratings
+    assert program.ratings_table.nnz == 4
+    assert answer({"ratings": [[4, 10, 3.5], [1, 12, 0]]}) == {"added": 2}
+    assert program.ratings_table.nnz == 6
+    assert answer({"user_id": 4})["movie_ids"] == [11, 12]
+
+
+def test_server_flush_error_skips_cancelled_requests():
+    program = LoadOnlyProgram()
+    program.load_ratings([1, 2], [10, 11], [4.0, 3.0])
+    program.do_cooccurrence_algorithm(score_users=False)
+    server = RecommendationServer(program)
+
+    def fail(user_ids, algorithm):
+        raise RuntimeError("scoring failed")
+    program.recommend_users = fail
+
+    async def requests():
+        loop = asyncio.get_running_loop()
+        cancelled, waiting = loop.create_future(), loop.create_future()
+        cancelled.cancel()
+        server.pending['cooccurrence'] = [(1, cancelled), (2, waiting)]
+        server.flush('cooccurrence')
+        return waiting
+
+    assert isinstance(asyncio.run(requests()).exception(), RuntimeError)
+
+
+def test_server_skips_lines_over_the_limit():
+    program = LoadOnlyProgram()
+    program.load_ratings([1, 1, 2, 3], [10, 11, 10, 12], [4.0, 3.0, 5.0, 2.0])
+    program.do_cooccurrence_algorithm(score_users=False)
+    server = RecommendationServer(program, max_request_bytes=1024)
+
+    async def session():
+        listener = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0,
+                                              limit=server.max_request_bytes)
+        reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname()[:2])
+        long_line = json.dumps({"ratings": [[1, 12, 3]] * 200}).encode() + b"\n"
+        writer.write(b'{"user_id": 2}\n' + long_line + b'{"user_id": 2}\n')
+        await writer.drain()
+        answers = [json.loads(await reader.readline()) for _ in range(3)]
+        writer.close()
+        listener.close()
+        await listener.wait_closed()
+        return answers
+
+    first, skipped, last = asyncio.run(session())
+    assert first == last == {"user_id": 2, "algorithm": "cooccurrence", "movie_ids": [11]}
+    assert "error" in skipped
+    assert program.ratings_table.nnz == 4
+
+
+def test_output_format_of_extension():
+    assert output_format_of("recs.bin") == "binary"
+    assert output_format_of("recs.jsonl") == "jsonl"
+    assert output_format_of("recs") == "csv"
+    with pytest.raises(ValueError):
+        output_format_of("recs.txt")
+
+
+def test_parse_bson_ratings_matches_documents():
+    bson = pytest.importorskip("bson")
+    documents = [{"user_id": 1, "movie_id": 2, "rating": 4},
+                 {"user_id": 1, "movie_id": 3, "rating": 3.5},
+                 {"user_id": bson.Int64(7), "movie_id": 3, "rating": 5.0},
+                 {"user_id": 2.0, "movie_id": 9, "rating": 1},
+                 {"rating": 2.5, "user_id": 4, "movie_id": 5},
+                 {"user_id": 5, "movie_id": 5, "rating": 2, "extra": [1, 2]},
+                 {"user_id": 2.5, "movie_id": 9, "rating": 1},
+                 {"user_id": "abc", "movie_id": 9, "rating": 1},
+                 {"user_id": 3, "movie_id": 9, "rating": 6},
+                 {"user_id": 3, "movie_id": -1, "rating": 2},
+                 {"movie_id": 9, "rating": 2},
+                 {"user_id": 6, "movie_id": 6, "rating": None},
+                 {"user_id": 6, "movie_id": 6, "rating": float("nan")},
+                 {"user_id": 1e300, "movie_id": 6, "rating": 2},
+                 {"user_id": 2.0 ** 63, "movie_id": 6, "rating": 2},
+                 {"user_id": float("inf"), "movie_id": 6, "rating": 2},
+                 {"user_id": float("nan"), "movie_id": 6, "rating": 2},
+                 {"user_id": 8, "movie_id": 8, "rating": 4}]
+    invalid = []
+    user_ids, movie_ids, ratings = parse_bson_ratings(b"".join(bson.encode(d) for d in documents), invalid=invalid)
+    assert user_ids.tolist() == [1, 1, 7, 2, 4, 5, 8]
+    assert movie_ids.tolist() == [2, 3, 3, 9, 5, 5, 8]
+    assert ratings.tolist() == [4.0, 3.5, 5.0, 1.0, 2.5, 2.0, 4.0]
+    assert [number for number, _, _ in invalid] == list(range(6, 17))
+    assert all(message.startswith("Invalid data: ") for _, message, _ in invalid)
+
+    # one layout per batch and a mix of int32 and double ratings
+    random_state = numpy.random.default_rng(0)
+    user_ids = random_state.integers(0, 10 ** 6, 2000)
+    movie_ids = random_state.integers(0, 10 ** 5, 2000)
+    ratings = random_state.integers(1, 11, 2000) / 2
+    for whole_as_int in (False, True):
+        batch = b"".join(bson.encode({"user_id": u, "movie_id": m,
+                                      "rating": int(r) if whole_as_int and r == int(r) else r})
+                         for u, m, r in zip(user_ids.tolist(), movie_ids.tolist(), ratings.tolist()))
+        parsed = parse_bson_ratings(batch)
+        assert all(numpy.array_equal(a, b) for a, b in zip(parsed, (user_ids, movie_ids, ratings)))
+
+
+def matches(document, query):
+    """a small MongoDB filter match: $and, $or, $gte, $lt, $type number, $not and equality"""
+    for key, condition in query.items():
+        if key in ("$and", "$or"):
+            found = [matches(document, part) for part in condition]
+            if not (all(found) if key == "$and" else any(found)):
+                return False
+            continue
+        value = document.get(key)
+        number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        if not isinstance(condition, dict):
+            if not (value == condition or (number and math.isnan(value) and math.isnan(condition))):
+                return False
+            continue
+        for operator, argument in condition.items():
+            if operator == "$type":
+                found = number
+            elif operator == "$not":
+                found = not matches(document, {key: argument})
+            elif operator == "$gte":
+                found = number and value >= argument
+            else:
+                found = number and value < argument
+            if not found:
+                return False
+    return True
+
+
+class FakeCursor(object):
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, key, direction):
+        self.documents = sorted(self.documents, key=lambda document: document[key], reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        return iter(self.documents[:count])
+
+
+class FakeCollection(object):
+    """the find and find_raw_batches of a pymongo collection over a list of documents"""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def project(self, query, projection):
+        return [{key: value for key, value in document.items() if projection.get(key)}
+                for document in self.documents if matches(document, query)]
+
+    def find(self, query, projection):
+        return FakeCursor(self.project(query, projection))
+
+    def find_raw_batches(self, query, projection, batch_size):
+        import bson
+        documents = self.project(query, projection)
+        for start in range(0, len(documents), batch_size):
+            yield b"".join(bson.encode(document) for document in documents[start:start + batch_size])
+
+
+def test_mongo_source_partitions_read_every_document(monkeypatch):
+    pytest.importorskip("pymongo")
+    random_state = random.Random(0)
+    documents = [{"user_id": random_state.randint(1, 500), "movie_id": random_state.randint(1, 50),
+                  "rating": random_state.choice([0.5, 1, 2, 3.5, 4, 5])} for _ in range(1000)]
+    documents += [{"user_id": "abc", "movie_id": 1, "rating": 3}, {"user_id": float("nan"), "movie_id": 1, "rating": 3},
+                  {"user_id": 1e300, "movie_id": 1, "rating": 3}, {"user_id": 7, "movie_id": 1, "rating": 9},
+                  {"movie_id": 1, "rating": 3}]
+    random_state.shuffle(documents)
+
+    class FakeClient(object):
+        def __init__(self, uri):
+            pass
+
+        def __getitem__(self, name):
+            return {"ratings": FakeCollection(documents)}
+
+    monkeypatch.setattr(new.pymongo, "MongoClient", FakeClient)
+    expected = sorted((d["user_id"], d["movie_id"], float(d["rating"])) for d in documents
+                      if isinstance(d.get("user_id"), int) and d["rating"] <= 5)
+    for partitions in (1, 3, 8):
+        source = MongoRatingsSource(batch_size=100, partitions=partitions)
+        filters = source.filters()
+        assert len(filters) == (1 if partitions == 1 else partitions + 1)
+        user_ids, movie_ids, ratings, invalid, count = source.read()
+        assert count == len(documents)
+        assert sorted(zip(user_ids.tolist(), movie_ids.tolist(), ratings.tolist())) == expected
+        assert len(invalid) == 5
+        if partitions > 1:
+            # every invalid document is named with the cursor that read it
+            assert all("cursor" in str(number) for number, _, _ in invalid)
+
+
+def random_ratings(count, users=40, movies=25, seed=0):
+    random_state = random.Random(seed)
+    return [(random_state.randint(1, users), random_state.randint(1, movies),
+             random_state.choice([0.0, 0.5, 1.0, 2.5, 3.0, 4.5, 5.0])) for _ in range(count)]
+
+
+def dense(matrix):
+    if isinstance(matrix, new.BlockedMatrix):
+        return numpy.hstack([matrix.block(k).toarray() for k in range(len(matrix.blocks))])
+    return matrix.toarray() if hasattr(matrix, "toarray") else numpy.asarray(matrix)
+
+
+@pytest.mark.parametrize("mode", ["dense", "sparse", "out_of_core", "compact", "cached"])
+def test_add_ratings_equals_full_rebuild(mode, tmp_path):
+    rows = random_ratings(300)
+    # the batch re-rates loaded pairs and brings new users and movies
+    batch = random_ratings(40, users=50, movies=30, seed=1) + rows[:5]
+    top_n = 3 if mode in ("sparse", "compact") else None
+
+    def build(ratings):
+        program = LoadOnlyProgram(storage='compact' if mode == "compact" else 'float64',
+                                  matrix_cache_dir=str(tmp_path / "cache") if mode == "cached" else None)
+        program.load_ratings(*zip(*ratings))
+        # every program spills to a directory of its own
+        blocks = str(tmp_path / ("blocks-%d" % len(ratings))) if mode == "out_of_core" else None
+        program.do_cooccurrence_algorithm(sparse_output=mode == "sparse", top_n=top_n, out_of_core_dir=blocks,
+                                          movie_block=7)
+        program.do_user_based_cos_similarity_algorithm(top_n=top_n)
+        return program
+
+    if mode == "cached":
+        build(rows)  # the next build reads its matrices from the cache
+    updated = build(rows)
+    assert mode != "cached" or all(updated.cache_hits.values())
+    updated.add_ratings(batch)
+    rebuilt = build(rows + batch)
+    assert updated.users_list == rebuilt.users_list and updated.movies_list == rebuilt.movies_list
+    assert numpy.array_equal(dense(updated.cooccurrence_matrix), dense(rebuilt.cooccurrence_matrix))
+    assert numpy.allclose(dense(updated.similar_matrix), dense(rebuilt.similar_matrix), atol=1e-6)
+    for user_id in set(row[0] for row in batch):
+        assert updated.users[user_id].recommend_movie_ids == rebuilt.users[user_id].recommend_movie_ids, user_id
+
+
+@pytest.mark.parametrize("top_n", [None, 3])
+def test_out_of_core_picks_equal_in_memory(top_n, tmp_path):
+    rows = random_ratings(400)
+    in_memory = LoadOnlyProgram()
+    in_memory.load_ratings(*zip(*rows))
+    in_memory.do_cooccurrence_algorithm(top_n=top_n)
+    blocked = LoadOnlyProgram()
+    blocked.load_ratings(*zip(*rows))
+    blocked.do_cooccurrence_algorithm(top_n=top_n, out_of_core_dir=str(tmp_path), movie_block=4)
+    assert len(blocked.cooccurrence_matrix.blocks) > 1
+    for user_id in in_memory.users_list:
+        assert (blocked.users[user_id].recommend_movie_ids['cooccurrence']
+                == in_memory.users[user_id].recommend_movie_ids['cooccurrence']), user_id
+
+    # a later run with another block size replaces every block file, and they go once removed
+    (tmp_path / "cooccurrence-0-4.mrsnap.tmp").write_bytes(b"left over")
+    names = set(path.name for path in tmp_path.iterdir())
+    blocked.do_cooccurrence_algorithm(top_n=top_n, out_of_core_dir=str(tmp_path), movie_block=10)
+    assert not names & set(path.name for path in tmp_path.iterdir())
+    blocked.remove_spilled_blocks()
+    assert not list(tmp_path.iterdir())
+
+
+def test_unreadable_cache_entries_are_misses(monkeypatch, tmp_path):
+    rows = random_ratings(200)
+    cache = tmp_path / "cache"
+
+    def build():
+        program = LoadOnlyProgram(matrix_cache_dir=str(cache))
+        program.load_ratings(*zip(*rows))
+        program.do_cooccurrence_algorithm()
+        return program
+
+    expected = build().cooccurrence_matrix
+    entry, = cache.iterdir()
+    bad_entries = [
+        lambda path: path.write_bytes(new.SNAPSHOT_MAGIC),  # truncated after the magic
+        lambda path: new.save_columns(str(path), user_id=numpy.arange(3)),  # a ratings snapshot
+        lambda path: new.save_matrices(str(path), {"similar_matrix": numpy.eye(2)}),  # another name
+    ]
+    for write in bad_entries:
+        write(entry)
+        program = build()
+        assert not program.cache_hits['cooccurrence']
+        assert numpy.array_equal(program.cooccurrence_matrix, expected)
+        # the bad entry was replaced by the built matrices
+        assert build().cache_hits['cooccurrence']
+
+    # a failed write leaves no temporary file behind
+    entry.unlink()
+
+    def failing_save(path, matrices):
+        with open(path, "wb") as f:
+            f.write(b"half")
+        raise OSError("disk full")
+    monkeypatch.setattr(new, "save_matrices", failing_save)
+    with pytest.raises(OSError):
+        build()
+    assert not list(cache.iterdir())
+
+
+def test_storage_modes_pick_like_float64(tmp_path):
+    rows = random_ratings(400)
+
+    def build(storage, snapshot=None):
+        program = LoadOnlyProgram(storage=storage)
+        if snapshot:
+            program.read_snapshot(snapshot)
+        else:
+            program.load_ratings(*zip(*rows))
+        program.do_cooccurrence_algorithm(top_n=5)
+        program.do_user_based_cos_similarity_algorithm(top_n=5)
+        return program
+
+    def picks(program):
+        return dict((user_id, program.users[user_id].recommend_movie_ids) for user_id in program.users_list)
+
+    expected = build('float64')
+    programs = dict((storage, build(storage)) for storage in ('float32', 'compact'))
+    for storage, program in programs.items():
+        assert picks(program) == picks(expected), storage
+    compact = programs['compact']
+    assert compact.ratings_table.dtype == numpy.uint8 and compact.cooccurrence_matrix.dtype == numpy.uint16
+    assert numpy.array_equal(new.decode_ratings(compact.ratings_table.data), expected.ratings_table.data)
+
+    # a compact snapshot keeps the rating codes, a float64 run reads them back as the ratings
+    snapshot = str(tmp_path / "compact.mrsnap")
+    compact.save_snapshot(snapshot)
+    reread = build('float64', snapshot)
+    assert reread.ratings_table.dtype == numpy.float64
+    assert (reread.ratings_table != expected.ratings_table).nnz == 0
+    assert picks(reread) == picks(expected)
+
+    # a count past the uint16 range widens the counts instead of wrapping around
+    matrix = compact.cooccurrence_matrix.copy()
+    matrix[0, 0] = numpy.iinfo(numpy.uint16).max
+    compact.cooccurrence_matrix = matrix
+    compact.add_ratings([(1000, compact.movies_list[0], 5.0)])
+    assert compact.cooccurrence_matrix.dtype == numpy.int64
+    assert compact.cooccurrence_matrix[0, 0] == numpy.iinfo(numpy.uint16).max + 1